@@ -23,3 +23,76 @@ CREATE TABLE category (
     art_id        INTEGER,
     PRIMARY KEY (cat_art_title, art_id)
 );
+
+CREATE TABLE render (
+    art_id       INTEGER PRIMARY KEY,
+    rend_version TEXT,
+    rend_mtime   TIMESTAMP,
+    rend_text    BLOB
+);
+
+CREATE TABLE render_link (
+    art_id   INTEGER,
+    rl_title TEXT,
+    rl_ns    TEXT,
+    PRIMARY KEY (art_id, rl_ns, rl_title)
+);
+
+CREATE INDEX render_link_target ON render_link (rl_ns, rl_title);
+
+CREATE TABLE pagelinks (
+    pl_from  INTEGER,
+    pl_ns    TEXT,
+    pl_title TEXT,
+    PRIMARY KEY (pl_from, pl_ns, pl_title)
+);
+
+CREATE INDEX pagelinks_target ON pagelinks (pl_ns, pl_title);
+
+CREATE UNIQUE INDEX article_subject ON article (art_ns, art_title);
+CREATE INDEX article_mtime ON article (art_mtime);
+CREATE INDEX category_article ON category (art_id);
+
+CREATE TRIGGER article_delete AFTER DELETE ON article
+BEGIN
+    DELETE FROM content     WHERE art_id = OLD.art_id;
+    DELETE FROM redirect    WHERE art_id = OLD.art_id;
+    DELETE FROM category    WHERE art_id = OLD.art_id;
+    DELETE FROM render      WHERE art_id = OLD.art_id;
+    DELETE FROM render_link WHERE art_id = OLD.art_id;
+    DELETE FROM pagelinks   WHERE pl_from = OLD.art_id;
+END;
+
+CREATE TABLE generation (
+    gen_value INTEGER
+);
+
+INSERT INTO generation VALUES (0);
+
+CREATE TRIGGER generation_insert AFTER INSERT ON article
+BEGIN
+    UPDATE generation SET gen_value = gen_value + 1;
+END;
+
+CREATE TRIGGER generation_update AFTER UPDATE ON article
+BEGIN
+    UPDATE generation SET gen_value = gen_value + 1;
+END;
+
+CREATE TRIGGER generation_delete AFTER DELETE ON article
+BEGIN
+    UPDATE generation SET gen_value = gen_value + 1;
+END;
+
+CREATE TABLE schema_version (
+    version     INTEGER PRIMARY KEY,
+    description TEXT,
+    applied     TIMESTAMP
+);
+
+INSERT INTO schema_version VALUES (1, 'article tables', CURRENT_TIMESTAMP);
+INSERT INTO schema_version VALUES (2, 'rendered article tables', CURRENT_TIMESTAMP);
+INSERT INTO schema_version VALUES (3, 'article subject and lookup indexes', CURRENT_TIMESTAMP);
+INSERT INTO schema_version VALUES (4, 'cascading article deletion', CURRENT_TIMESTAMP);
+INSERT INTO schema_version VALUES (5, 'article link table', CURRENT_TIMESTAMP);
+INSERT INTO schema_version VALUES (6, 'article generation counter', CURRENT_TIMESTAMP);
@@ -0,0 +1,6 @@
+@echo off
+setlocal
+set script_path=%~dp0
+set src_path=%script_path%src
+set PYTHONPATH=%PYTHONPATH%;%src_path%
+python %src_path%\db_import.py %*
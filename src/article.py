@@ -86,6 +86,9 @@ class Subject(object):
     def __ne__(self, subject):
         return not self.__eq__(subject)
 
+    def __hash__(self):
+        return hash((self.__ns, self.__title))
+
     @classmethod
     def fromString(cls, value):
         """Convert a string into a subject.
@@ -140,6 +143,15 @@ class Article(object):
         """
         pass
 
+    def getModificationTime(self):
+        """Get the last modification timestamp of this article.
+
+        Get None if the article is not stored yet.
+        
+        @rtype: unicode
+        """
+        pass
+
 class UserArticle(Article):
     """A user article is an article a user can read.
     
@@ -148,12 +160,15 @@ class UserArticle(Article):
     @param content: unicode
     @param categories: a list of category titles
     @type categories: list, tuple
+    @param mtime: last modification timestamp
+    @type mtime: unicode
     """
     
-    def __init__(self, subject, content, categories=()):
+    def __init__(self, subject, content, categories=(), mtime=None):
         self.__subject = subject
         self.__content = content
         self.__categories = categories
+        self.__mtime = mtime
 
     def getSubject(self):
         return self.__subject
@@ -167,6 +182,9 @@ class UserArticle(Article):
     def getCategories(self):
         return self.__categories
 
+    def getModificationTime(self):
+        return self.__mtime
+
 class RedirectArticle(Article):
     """Redirection article.
     
@@ -174,10 +192,13 @@ class RedirectArticle(Article):
     @type subject: L{Subject}
     @param redirect_to: the article subject it is redirected to
     @type redirect_to: L{Subject} 
+    @param mtime: last modification timestamp
+    @type mtime: unicode
     """
-    def __init__(self, subject, redirect_to):
+    def __init__(self, subject, redirect_to, mtime=None):
         self.__subject = subject
         self.__redirect = redirect_to
+        self.__mtime = mtime
 
     def getSubject(self):
         return self.__subject
@@ -206,6 +227,9 @@ class RedirectArticle(Article):
         """
         return ()
 
+    def getModificationTime(self):
+        return self.__mtime
+
 class CategoryArticle(UserArticle):
     """A category is a kind of article which help to class other articles.
     
@@ -222,9 +246,11 @@ class CategoryArticle(UserArticle):
     @type subjects: list, tuple
     @param categories: a list of category titles
     @type categories: dict
+    @param mtime: last modification timestamp
+    @type mtime: unicode
     """
-    def __init__(self, subject, content, subjects, categories=()):
-        UserArticle.__init__(self, subject, content, categories)
+    def __init__(self, subject, content, subjects, categories=(), mtime=None):
+        UserArticle.__init__(self, subject, content, categories, mtime)
         self.__subjects = subjects
 
     def getSubjects(self):
@@ -383,6 +409,36 @@ class ArticleManager(object):
         """
         pass
     
+    def filterExisting(self, subjects):
+        """Get the subjects, among the given ones, the manager owns.
+        
+        Managers backed by a database should check all the subjects at once.
+        
+        @param subjects: subjects to check.
+        @type subjects: iterable of L{Subject}
+        @return: the set of the existing subjects.
+        @rtype: set
+        """
+        return set(subject for subject in subjects if self.contains(subject))
+    
+    def refresh(self):
+        """Take into account the changes made to the articles by other
+        processes.
+        
+        @return: True if the articles may have changed since the last call.
+        @rtype: bool
+        """
+        return False
+    
+    def getGeneration(self):
+        """Get a number changing each time an article is set or deleted,
+        shared by all the processes using the same articles.
+        
+        @return: the generation, or None if the manager doesn't keep one.
+        @rtype: int
+        """
+        return None
+    
     def delete(self, subject): pass
     def subjects(self): pass
     
@@ -405,6 +461,9 @@ class ReadOnlyArticleManager(ArticleManager):
     def contains(self, subject):
         return self.__art_mgr.contains(subject)
 
+    def filterExisting(self, subjects):
+        return self.__art_mgr.filterExisting(subjects)
+
     def get(self, subject):
         return self.__art_mgr.get(subject)
 
@@ -425,6 +484,9 @@ class DummyArticleManager(ArticleManager):
     def contains(self, subject):
         return True
 
+    def filterExisting(self, subjects):
+        return set(subjects)
+
     def get(self, subject):
         return self.__artCls(subject)
 
@@ -0,0 +1,237 @@
+# cache.py -
+#
+
+import manager
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Least recently used cache.
+
+    The cache is capped by the total size of its values. The size of a value
+    is given by the sizeof function (default: len). When the cache is full,
+    the least recently used entries are evicted and passed to the evicted
+    callback, if any.
+    """
+    def __init__(self, max_size, sizeof=len, evicted=None):
+        self.__maxSize = max_size
+        self.__sizeof = sizeof
+        self.__evicted = evicted
+        self.__size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value, size = self.__entries.pop(key)
+            except KeyError:
+                return default
+            # the entry becomes the most recently used one
+            self.__entries[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        size = self.__sizeof(value)
+        with self.__lock:
+            self.delete(key)
+            if size > self.__maxSize:
+                # the value would evict everything else
+                return
+            self.__entries[key] = (value, size)
+            self.__size += size
+            while self.__size > self.__maxSize:
+                old_key, (old_value, old_size) = self.__entries.popitem(last=False)
+                self.__size -= old_size
+                if self.__evicted is not None:
+                    self.__evicted(old_key, old_value)
+
+    def delete(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                value, size = self.__entries.pop(key)
+                self.__size -= size
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    def getSize(self):
+        return self.__size
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+class RenderCache(manager.ManagerListener):
+    """Cache of the rendered content of the articles.
+
+    An entry is identified by the article subject and is only valid for the
+    modification time of the article it was rendered from. The cache keeps
+    track of the subjects each entry links to: when a subject is created or
+    deleted, the entries linking to it are invalidated, as the class of
+    their links (defined/undefined) changes. The included templates count as
+    links: the entries including a template are invalidated when it is
+    modified.
+    """
+    def __init__(self, max_size):
+        self.__cache = LRUCache(max_size,
+                                sizeof=lambda entry: len(entry[1]),
+                                evicted=self.__evicted)
+        # linked subject -> subjects of the entries linking to it
+        self.__linkedFrom = {}
+        # guard the consistency between the entries and the links
+        self.__lock = threading.RLock()
+
+    def __evicted(self, subject, entry):
+        mtime, content, links = entry
+        for link in links:
+            subjects = self.__linkedFrom.get(link)
+            if subjects is not None:
+                subjects.discard(subject)
+                if len(subjects) == 0:
+                    del self.__linkedFrom[link]
+
+    def get(self, art):
+        """Get the rendered content of an article, or None.
+        """
+        mtime = art.getModificationTime()
+        if mtime is None:
+            return None
+        entry = self.__cache.get(art.getSubject())
+        if entry is None or entry[0] != mtime:
+            return None
+        return entry[1]
+
+    def put(self, art, content, links):
+        """Store the rendered content of an article.
+
+        @param links: subjects the rendered content links to.
+        """
+        mtime = art.getModificationTime()
+        if mtime is None:
+            return
+        subject = art.getSubject()
+        links = frozenset(links)
+        with self.__lock:
+            self.invalidate(subject)
+            self.__cache.put(subject, (mtime, content, links))
+            if subject in self.__cache:
+                for link in links:
+                    self.__linkedFrom.setdefault(link, set()).add(subject)
+
+    def invalidate(self, subject):
+        with self.__lock:
+            entry = self.__cache.get(subject)
+            if entry is not None:
+                self.__cache.delete(subject)
+                self.__evicted(subject, entry)
+
+    def invalidateLinksTo(self, subject):
+        with self.__lock:
+            for linking in tuple(self.__linkedFrom.get(subject, ())):
+                self.invalidate(linking)
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.__linkedFrom.clear()
+
+    def articleSet(self, subject, created):
+        self.invalidate(subject)
+        if created or subject.getNamespace() == manager.TEMPLATE_NS:
+            self.invalidateLinksTo(subject)
+
+    def articleDeleted(self, subject):
+        self.invalidate(subject)
+        self.invalidateLinksTo(subject)
+
+    def articlesReset(self):
+        self.clear()
+
+class RenderStore(manager.ManagerListener):
+    """Persistent store of the rendered articles (render-on-write).
+
+    The articles are rendered when they are saved and their content is
+    stored in the database next to their source, so that consulting them
+    only costs a lookup. A stored content is only valid for the parser
+    version and the article modification time it was rendered with. When a
+    subject is created or deleted, or a template is modified, the article
+    manager drops the stored content of the articles linking to it or
+    including it, which are rendered again on the next consultation.
+
+    @param art_mgr: a L{sqldb.SqlArticleManager}.
+    @param wiki_manager: manager used to get the articles to render.
+    @param parser: parser used to render the articles.
+    @param version: version of the parser.
+    """
+    def __init__(self, art_mgr, wiki_manager, parser, version):
+        self.__art_mgr = art_mgr
+        self.__manager = wiki_manager
+        self.__parser = parser
+        self.__version = version
+
+    def lookup(self, art):
+        """Get the stored rendered content of an article, or None.
+        """
+        mtime = art.getModificationTime()
+        if mtime is None:
+            return None
+        row = self.__art_mgr.getRendered(art.getSubject(), self.__version)
+        if row is None or row[1] != mtime:
+            return None
+        return row[0]
+
+    def getLinks(self, subject):
+        return self.__art_mgr.getRenderedLinks(subject)
+
+    def put(self, art, content, links):
+        mtime = art.getModificationTime()
+        if mtime is None:
+            return
+        self.__art_mgr.setRendered(art.getSubject(), self.__version, mtime,
+                                   content, links)
+
+    def render(self, subject, force=False):
+        """Render an article and store its content.
+
+        Unless force is True, an article whose stored content is still valid
+        is not rendered again.
+
+        @return: True if the article has been rendered.
+        """
+        art = self.__manager.get(subject)
+        if art.redirectTo() is not None:
+            return False
+        if not force and self.lookup(art) is not None:
+            return False
+        content, links = self.__parser.render(art)
+        self.put(art, content, links)
+        return True
+
+    def renderAll(self, force=False):
+        """Render all the articles whose stored content is not valid anymore.
+
+        @return: the number of rendered articles.
+        """
+        count = 0
+        for ns, stat_list in self.__art_mgr.subjects().items():
+            if not self.__manager.recognizeNs(ns):
+                continue
+            for stats in stat_list:
+                if stats.isRedirect():
+                    continue
+                if self.render(stats.getSubject(), force):
+                    count += 1
+        return count
+
+    def articleSet(self, subject, created):
+        # the content of the articles linking to the subject has been
+        # dropped with the write (see sqldb.SqlArticleManager)
+        self.render(subject, True)
+
+# End
@@ -0,0 +1,80 @@
+# db_export.py - dump all the articles of a wiki as JSON lines
+#
+
+import sqldb
+import json
+import sys
+
+def iterArticles(db_conn):
+    """Iterate over the articles of a wiki database as dictionaries.
+
+    The articles are read one at a time, as well as their categories (the
+    two queries are sorted by article id and merged).
+    """
+    articles = db_conn.cursor()
+    articles.execute("""
+SELECT article.art_id, art_title, art_ns, art_ctime, art_mtime,
+       rd_title, rd_ns, cont_text
+FROM
+  article
+    LEFT JOIN redirect ON article.art_id = redirect.art_id
+    LEFT JOIN content  ON article.art_id = content.art_id
+ORDER BY article.art_id
+""")
+    categories = db_conn.cursor()
+    categories.execute("""
+SELECT art_id, cat_art_title
+FROM category
+ORDER BY art_id, rowid
+""")
+    category = categories.fetchone()
+    for art_id, title, ns, ctime, mtime, rd_title, rd_ns, content in articles:
+        record = {'title': title, 'ns': ns, 'ctime': ctime, 'mtime': mtime}
+        cat_titles = []
+        while category is not None and category[0] <= art_id:
+            if category[0] == art_id:
+                cat_titles.append(category[1])
+            category = categories.fetchone()
+        if rd_title is not None:
+            record['redirect'] = {'title': rd_title, 'ns': rd_ns}
+        else:
+            record['content'] = content
+            record['categories'] = cat_titles
+        yield record
+    articles.close()
+    categories.close()
+
+def exportArticles(db_conn, out):
+    """Write the articles of a wiki database to a file, one JSON object per
+    line.
+
+    @return: the number of exported articles.
+    """
+    count = 0
+    for record in iterArticles(db_conn):
+        line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+        if isinstance(line, unicode):
+            line = line.encode('utf8')
+        out.write(line + '\n')
+        count += 1
+    return count
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print "USAGE: db_export.py db_name [jsonl_file]"
+        sys.exit(0)
+
+    db_name = sys.argv[1]
+    db_conn = sqldb.connect(db_name)
+    out = sys.stdout
+    if len(sys.argv) == 3:
+        out = open(sys.argv[2], 'wb')
+    try:
+        count = exportArticles(db_conn, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    db_conn.close()
+    print >>sys.stderr, "%d article(s) exported from %s" % (count, db_name)
+
+# End
@@ -0,0 +1,278 @@
+# db_import.py - load articles dumped by db_export.py into a wiki
+#
+
+import sqldb
+import dbschema
+from wikiparser import extractLinks
+import json
+import sys
+
+# number of articles written by transaction
+BATCH_SIZE = 2000
+
+# indexes built once at the end of an import into an empty wiki
+_DEFERRED_INDEXES = ('article_mtime', 'category_article', 'pagelinks_target')
+
+def _parseRecord(line):
+    record = json.loads(line)
+    # the title of the home page is empty
+    if not isinstance(record, dict) or record.get('title') is None:
+        raise ValueError, "an article needs a title"
+    title = record['title']
+    ns = record.get('ns') or u''
+    ctime = record.get('ctime')
+    mtime = record.get('mtime')
+    redirect = record.get('redirect')
+    if redirect is not None:
+        if not isinstance(redirect, dict) or redirect.get('title') is None:
+            raise ValueError, "a redirection needs a title"
+        return ((title, ns, ctime, mtime, None,
+                 redirect['title'], redirect.get('ns') or u''), ())
+    content = record.get('content') or u''
+    categories = []
+    for category in record.get('categories') or ():
+        if category not in categories:
+            categories.append(category)
+    return (title, ns, ctime, mtime, content, None, None), categories
+
+class ArticleImporter(object):
+    """Write articles into a wiki database by large batches.
+
+    The articles are staged in temporary tables, then copied into the wiki
+    tables with a few statements per batch. An imported article replaces
+    the article with the same subject, if any, and its links are extracted
+    from its content. The stored rendered content of the articles linking to
+    an imported subject is dropped.
+
+    The secondary indexes dropped for an import into an empty wiki are built
+    again by L{close}, or by L{buildIndexes} if the import fails.
+
+    @param db_conn: connection to a database at the current schema version.
+    """
+    def __init__(self, db_conn, batch_size=BATCH_SIZE):
+        self.__conn = db_conn
+        self.__batchSize = batch_size
+        self.__articles = []
+        self.__categories = []
+        self.__links = []
+        self.__subjects = set()
+        self.__count = 0
+        self.__deferred = []
+        cursor = self.__conn.cursor()
+        cursor.executescript("""
+CREATE TEMP TABLE IF NOT EXISTS import_article (
+    seq      INTEGER PRIMARY KEY,
+    title    TEXT,
+    ns       TEXT,
+    ctime    TIMESTAMP,
+    mtime    TIMESTAMP,
+    content  BLOB,
+    rd_title TEXT,
+    rd_ns    TEXT
+);
+
+CREATE TEMP TABLE IF NOT EXISTS import_category (
+    seq   INTEGER,
+    title TEXT
+);
+
+CREATE TEMP TABLE IF NOT EXISTS import_link (
+    seq   INTEGER,
+    ns    TEXT,
+    title TEXT
+);
+""")
+        cursor.execute("""
+SELECT COUNT(*)
+FROM article
+""")
+        if int(cursor.fetchone()[0]) == 0:
+            # maintaining the secondary indexes costs more than building them
+            for name in _DEFERRED_INDEXES:
+                cursor.execute("""
+SELECT sql
+FROM sqlite_master
+WHERE type = 'index'
+  AND name = ?
+""", (name,))
+                row = cursor.fetchone()
+                if row is not None:
+                    self.__deferred.append(row[0])
+                    cursor.execute("DROP INDEX %s" % name)
+            self.__conn.commit()
+        cursor.close()
+
+    def add(self, row, categories):
+        """Add an article to the current batch.
+
+        @param row: (title, ns, ctime, mtime, content, rd_title, rd_ns).
+        @param categories: titles of the categories of the article.
+        """
+        subject = (row[1], row[0])
+        if subject in self.__subjects or len(self.__articles) >= self.__batchSize:
+            self.flush()
+        seq = len(self.__articles)
+        self.__subjects.add(subject)
+        self.__articles.append((seq,) + tuple(row))
+        for category in categories:
+            self.__categories.append((seq, category))
+        content, rd_title, rd_ns = row[4:]
+        if rd_title is not None:
+            self.__links.append((seq, rd_ns, rd_title))
+        else:
+            for link in extractLinks(content):
+                self.__links.append((seq, link.getNamespace(), link.getTitle()))
+
+    def flush(self):
+        """Write the current batch in a single transaction.
+        """
+        if len(self.__articles) == 0:
+            return
+        cursor = self.__conn.cursor()
+        cursor.executemany("""
+INSERT INTO import_article
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+""", self.__articles)
+        cursor.executemany("""
+INSERT INTO import_category
+    VALUES (?, ?)
+""", self.__categories)
+        cursor.executemany("""
+INSERT INTO import_link
+    VALUES (?, ?, ?)
+""", self.__links)
+        # the replaced articles are cleaned up by the article_delete trigger
+        cursor.execute("""
+DELETE FROM article
+WHERE art_id IN (SELECT art_id
+                 FROM article, import_article
+                 WHERE art_ns = ns
+                   AND art_title = title)
+""")
+        cursor.execute("""
+INSERT INTO article (art_title, art_ns, art_ctime, art_mtime)
+SELECT title, ns, COALESCE(ctime, CURRENT_TIMESTAMP),
+       COALESCE(mtime, CURRENT_TIMESTAMP)
+FROM import_article
+ORDER BY seq
+""")
+        cursor.execute("""
+INSERT INTO content
+SELECT art_id, content, LENGTH(content)
+FROM import_article, article
+WHERE art_ns = ns
+  AND art_title = title
+  AND rd_title IS NULL
+""")
+        cursor.execute("""
+INSERT INTO redirect
+SELECT art_id, rd_title, rd_ns
+FROM import_article, article
+WHERE art_ns = ns
+  AND art_title = title
+  AND rd_title IS NOT NULL
+""")
+        cursor.execute("""
+INSERT INTO category
+SELECT import_category.title, art_id
+FROM import_category, import_article, article
+WHERE import_category.seq = import_article.seq
+  AND art_ns = ns
+  AND art_title = import_article.title
+ORDER BY import_category.rowid
+""")
+        cursor.execute("""
+INSERT OR IGNORE INTO pagelinks
+SELECT art_id, import_link.ns, import_link.title
+FROM import_link, import_article, article
+WHERE import_link.seq = import_article.seq
+  AND art_ns = import_article.ns
+  AND art_title = import_article.title
+""")
+        # the links to the imported subjects may have changed class
+        cursor.execute("""
+DELETE FROM render
+WHERE art_id IN (SELECT art_id
+                 FROM render_link, import_article
+                 WHERE rl_ns = ns
+                   AND rl_title = title)
+""")
+        cursor.execute("DELETE FROM import_article")
+        cursor.execute("DELETE FROM import_category")
+        cursor.execute("DELETE FROM import_link")
+        cursor.close()
+        self.__conn.commit()
+        self.__count += len(self.__articles)
+        self.__articles = []
+        self.__categories = []
+        self.__links = []
+        self.__subjects = set()
+
+    def close(self):
+        """Write the last batch and build the deferred indexes.
+
+        @return: the number of imported articles.
+        """
+        self.flush()
+        self.buildIndexes()
+        return self.__count
+
+    def buildIndexes(self):
+        """Build the deferred indexes, if any, dropping the batch being
+        written.
+        """
+        if len(self.__deferred) == 0:
+            return
+        self.__conn.rollback()
+        cursor = self.__conn.cursor()
+        while self.__deferred:
+            cursor.execute(self.__deferred[0])
+            del self.__deferred[0]
+        cursor.close()
+        self.__conn.commit()
+
+def importArticles(db_conn, lines, batch_size=BATCH_SIZE):
+    """Import articles from JSON lines (see L{db_export}).
+
+    @return: the number of imported articles.
+    """
+    importer = ArticleImporter(db_conn, batch_size)
+    try:
+        for line_nb, line in enumerate(lines):
+            if line.strip() == '':
+                continue
+            try:
+                row, categories = _parseRecord(line)
+            except ValueError, e:
+                # keep the articles read so far
+                importer.close()
+                raise ValueError, "line %d: %s" % (line_nb + 1, e)
+            importer.add(row, categories)
+        return importer.close()
+    finally:
+        # the wiki keeps its indexes whatever the failure
+        importer.buildIndexes()
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print "USAGE: db_import.py db_name [jsonl_file]"
+        sys.exit(0)
+
+    db_name = sys.argv[1]
+    db_conn = sqldb.connect(db_name, journal_mode='wal')
+    dbschema.migrate(db_conn)
+    lines = sys.stdin
+    if len(sys.argv) == 3:
+        lines = open(sys.argv[2], 'rb')
+    try:
+        count = importArticles(db_conn, lines)
+    except ValueError, e:
+        print >>sys.stderr, "(**) %s" % (e,)
+        sys.exit(1)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        db_conn.close()
+    print >>sys.stderr, "%d article(s) imported into %s" % (count, db_name)
+
+# End
@@ -0,0 +1,40 @@
+# db_migrate.py -
+#
+
+import dbschema
+import sqlite3
+import os, sys
+
+if len(sys.argv) == 1 or len(sys.argv) > 3 \
+   or (len(sys.argv) == 3 and sys.argv[1] != '-n'):
+    print "USAGE: db_migrate.py [-n] db_name"
+    sys.exit(0)
+
+db_name = sys.argv[-1]
+is_dry_run = (len(sys.argv) == 3)
+
+if not os.path.exists(db_name):
+    print "(**) %s doesn't exist" % (db_name,)
+    sys.exit(1)
+
+db_conn = sqlite3.connect(db_name)
+version = dbschema.getSchemaVersion(db_conn)
+print "%s is at version %d (current version: %d)" \
+      % (db_name, version, dbschema.SCHEMA_VERSION)
+
+if is_dry_run:
+    for version, description, script in dbschema.getPendingMigrations(db_conn):
+        print "--> would migrate to version %d: %s" % (version, description)
+else:
+    try:
+        for version, description, script in dbschema.migrate(db_conn):
+            print "--> migrated to version %d: %s" % (version, description)
+    except sqlite3.Error, e:
+        print "(**) migration failed: %s" % (e,)
+        print "(**) %s is at version %d" \
+              % (db_name, dbschema.getSchemaVersion(db_conn))
+        db_conn.close()
+        sys.exit(1)
+db_conn.close()
+
+# End
@@ -0,0 +1,398 @@
+# db_publish.py - export the wiki as a static web site
+#
+
+import sqldb
+import dbschema
+import subjindex
+import article
+import manager
+import formatter
+import wikiparser
+import wikipage
+import webpage
+from pwiki import buildWikiManager, WIKI_NAME, __copyright__
+
+import hashlib
+import json
+import multiprocessing
+import optparse
+import os
+import re
+import shutil
+import sys
+
+# directory of the stylesheet and the images in the site
+STATIC_DIR = '_static'
+
+# file of the site keeping track of the published pages
+MANIFEST_NAME = '.pwiki-manifest.json'
+
+# version of the layout of the site, part of the manifest version
+_SITE_VERSION = u'2'
+
+_SYSTEM_LIST = article.Subject('List', manager.SYSTEM_NS)
+_SYSTEM_WANTED = article.Subject('Wanted', manager.SYSTEM_NS)
+
+# characters which can't appear in a file name on some systems, and the
+# escape character
+_reserved_re = re.compile(ur'[\x00-\x1f<>:"\\|?*%]')
+# names of the devices on Windows, which can't name a file
+_DEVICE_NAMES = frozenset([u'CON', u'PRN', u'AUX', u'NUL']
+                          + [u'COM%d' % i for i in range(1, 10)]
+                          + [u'LPT%d' % i for i in range(1, 10)])
+
+# links of the wiki in the pages (href="/Subject")
+_href_re = re.compile(r'(href="/)([^"?#]*)')
+
+def _escapeChar(char):
+    return u'%%%02X' % ord(char)
+
+def _fileName(part):
+    """Get the file name of a part of a subject, where the characters
+    reserved in a file name are escaped like in a URL (%3A for ':').
+    """
+    part = _reserved_re.sub(lambda match: _escapeChar(match.group(0)), part)
+    if part[-1] in u'. ':
+        part = part[:-1] + _escapeChar(part[-1])
+    if part.split(u'.')[0].upper() in _DEVICE_NAMES:
+        part = _escapeChar(part[0]) + part[1:]
+    return part
+
+def _subjectParts(subject_st):
+    """Get the file names of the directories of the page of a subject, or
+    None if the subject can't be published.
+    """
+    parts = []
+    if subject_st != u'':
+        parts = subject_st.split(u'/')
+    for part in parts:
+        if part in (u'', u'.', u'..'):
+            return None
+    if len(parts) > 0 and parts[0] == STATIC_DIR:
+        return None
+    return [_fileName(part) for part in parts]
+
+def pagePath(subject):
+    """Get the path of the page of a subject, relative to the site
+    directory, or None if the subject can't be published.
+
+    The page of a subject is the index.html file of a directory with its
+    name, so that the links of the pages (see L{pageUrl}) are followed by
+    a plain static file server.
+    """
+    parts = _subjectParts(unicode(subject))
+    if parts is None:
+        return None
+    return os.path.join(*([part.encode('utf8') for part in parts]
+                          + ['index.html']))
+
+def pageUrl(subject):
+    """Get the URL of the page of a subject in the site, or None if the
+    subject can't be published.
+
+    The escape character of the file names is escaped in turn, since the
+    server decodes the URL before looking the file up.
+    """
+    parts = _subjectParts(unicode(subject))
+    if parts is None:
+        return None
+    return u'/' + u'/'.join(parts).replace(u'%', u'%25')
+
+def _rewriteLink(match):
+    # the link is escaped as an attribute
+    subject_st = match.group(2).decode('utf8')
+    for entity, char in ((u'&quote;', u'"'), (u'&quot;', u'"'),
+                         (u'&lt;', u'<'), (u'&gt;', u'>'), (u'&amp;', u'&')):
+        subject_st = subject_st.replace(entity, char)
+    url = pageUrl(article.Subject.fromString(subject_st))
+    if url is None:
+        return match.group(0)
+    return match.group(1) + formatter.escape(url[1:], True).encode('utf8')
+
+def _rewriteLinks(chunks):
+    """Replace the links of the wiki in the pieces of a page encoded in UTF-8
+    by the URL of the pages in the site.
+
+    A tag split between two pieces is completed by the next piece first.
+    """
+    pending = ''
+    for chunk in chunks:
+        chunk = pending + chunk
+        pos = chunk.rfind('<')
+        if pos >= 0 and chunk.find('>', pos) < 0:
+            chunk, pending = chunk[:pos], chunk[pos:]
+        else:
+            pending = ''
+        yield _href_re.sub(_rewriteLink, chunk)
+    yield _href_re.sub(_rewriteLink, pending)
+
+class _Wiki(object):
+    """The objects needed to render the pages of a wiki database.
+    """
+    def __init__(self, db_name, template):
+        self.connection = sqldb.connect(db_name)
+        art_mgr = sqldb.SqlArticleManager(self.connection,
+                                          subjindex.SubjectIndex())
+        self.art_mgr = art_mgr
+        # a static site has no page of the links to each subject
+        # nor edit links
+        self.manager = buildWikiManager(art_mgr, links_page=False,
+                                        editable=False)
+        self.parser = wikiparser.WikiParser(formatter.HtmlBuilder(),
+                                            self.manager)
+        self.page_factory = wikipage.WikiPageFactory(
+            WIKI_NAME, __copyright__, self.parser, None, self.manager,
+            template, stylesheet_url='/%s/wiki.css' % STATIC_DIR,
+            editable=False)
+        # the menu is rendered once, before the articles (see getLinks)
+        self.menu = self.page_factory.buildMenu()
+
+    def getVersion(self):
+        """Get a key changing with everything the pages depend on, apart
+        from the articles themselves.
+        """
+        key = u'|'.join((_SITE_VERSION, wikiparser.PARSER_VERSION,
+                         self.page_factory.getVersion(), self.menu))
+        return hashlib.md5(key.encode('utf8')).hexdigest()
+
+    def close(self):
+        self.connection.close()
+
+# wiki of a worker process
+_wiki = None
+
+def _initWorker(db_name, template):
+    global _wiki
+    _wiki = _Wiki(db_name, template)
+
+def _articleKey(art):
+    """Get a key changing each time the page of an article changes, apart
+    from the class of its links and its templates.
+    """
+    key = [unicode(art.getModificationTime())]
+    if art.getSubject().getNamespace() == manager.CATEGORY_NS:
+        # the page lists the subjects of the category
+        for ns, subjects in sorted(art.getSubjects().items()):
+            key.extend(unicode(subject) for subject in subjects)
+    return hashlib.md5(u'\n'.join(key).encode('utf8')).hexdigest()
+
+def _linkState(subject):
+    """Get the state of a linked subject the page depends on: whether it
+    exists, or the modification time of an included template.
+    """
+    if subject.getNamespace() == manager.TEMPLATE_NS \
+       and _wiki.manager.contains(subject):
+        return _wiki.manager.get(subject).getModificationTime()
+    return _wiki.manager.contains(subject)
+
+def _isUpToDate(entry, key):
+    if entry is None or key is None or entry['key'] != key:
+        return False
+    for ns, title, state in entry['links']:
+        if _linkState(article.Subject(title, ns)) != state:
+            return False
+    return True
+
+def _buildRedirectPage(art):
+    target = unicode(art.redirectTo())
+    # the link is rewritten with the others (see _rewriteLinks)
+    url = formatter.escape(pageUrl(art.redirectTo()) or u'/' + target, True)
+    header = webpage.WebPageHeader(WIKI_NAME + ' >>> ' + unicode(art.getSubject()))
+    header.append('<meta http-equiv="refresh" content="0; url=%s" />' % url)
+    content = webpage.WebPageContent('<p><a href="/%s">%s</a></p>'
+                                     % (formatter.escape(target, True),
+                                        formatter.escape(target)))
+    return webpage.WebPage(header, content)
+
+def _publishArticle(task):
+    """Render the page of an article into the site, unless it is up to date.
+
+    @param task: (site directory, title, ns, manifest entry or None).
+    @return: (subject, new manifest entry, True if the page was rendered).
+    """
+    out_dir, title, ns, entry = task
+    subject = article.Subject(title, ns)
+    art = _wiki.manager.get(subject)
+    key = None
+    if ns != manager.SYSTEM_NS:
+        key = _articleKey(art)
+    if _isUpToDate(entry, key):
+        return unicode(subject), entry, False
+    links = []
+    if art.redirectTo() is not None:
+        page = _buildRedirectPage(art)
+        links = [art.redirectTo()]
+    else:
+        page = _wiki.page_factory.buildConsultPage(art)
+    path = pagePath(subject)
+    full_path = os.path.join(out_dir, path)
+    if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+    f = open(full_path + '.tmp', 'wb')
+    try:
+        # the article is rendered while the page is generated
+        for chunk in _rewriteLinks(page.iterHtml('UTF-8')):
+            f.write(chunk)
+    finally:
+        f.close()
+    if art.redirectTo() is None and ns != manager.SYSTEM_NS:
+        # links of the article (the menu is already rendered)
+        links = _wiki.parser.getLinks()
+    os.rename(full_path + '.tmp', full_path)
+    entry = {'key': key, 'path': path,
+             'links': [[link.getNamespace(), link.getTitle(), _linkState(link)]
+                       for link in set(links)]}
+    return unicode(subject), entry, True
+
+def _entryPath(entry):
+    path = entry['path']
+    if isinstance(path, unicode):
+        # read back from the manifest
+        path = path.encode('utf8')
+    return path
+
+def _removePage(out_dir, path):
+    full_path = os.path.join(out_dir, path)
+    if os.path.exists(full_path):
+        os.remove(full_path)
+    # remove the directories left empty
+    directory = os.path.dirname(full_path)
+    while os.path.abspath(directory) != os.path.abspath(out_dir):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+def _copyStaticFiles(out_dir, stylesheet, img_dir):
+    static_dir = os.path.join(out_dir, STATIC_DIR)
+    if not os.path.isdir(os.path.join(static_dir, 'img')):
+        os.makedirs(os.path.join(static_dir, 'img'))
+    f = open(stylesheet, 'rb')
+    try:
+        css = f.read()
+    finally:
+        f.close()
+    # the images are served by the wiki with /?getimage=name
+    css = css.replace('/?getimage=', '/%s/img/' % STATIC_DIR)
+    f = open(os.path.join(static_dir, 'wiki.css'), 'wb')
+    try:
+        f.write(css)
+    finally:
+        f.close()
+    if os.path.isdir(img_dir):
+        for name in os.listdir(img_dir):
+            path = os.path.join(img_dir, name)
+            if os.path.isfile(path):
+                shutil.copy2(path, os.path.join(static_dir, 'img', name))
+
+def publish(db_name, out_dir, template=None, stylesheet='css/wiki.css',
+            img_dir='img', nb_jobs=None, force=False):
+    """Export the pages of a wiki as a static web site.
+
+    The site keeps a manifest of the published pages: unless force is
+    True, only the pages of the articles modified since the last export,
+    whose links have been created or deleted, or whose templates have been
+    modified, are rendered again. The
+    pages are rendered by a pool of nb_jobs processes (default: one per
+    CPU).
+
+    @return: the tuple (number of rendered pages, number of pages up to
+    date, number of removed pages).
+    """
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = {'version': None, 'pages': {}}
+    if not force and os.path.exists(manifest_path):
+        f = open(manifest_path, 'rb')
+        try:
+            manifest = json.load(f)
+        finally:
+            f.close()
+
+    # the wanted articles are read from the links of the current schema
+    connection = sqldb.connect(db_name)
+    try:
+        dbschema.migrate(connection)
+    finally:
+        connection.close()
+
+    wiki = _Wiki(db_name, template)
+    try:
+        version = wiki.getVersion()
+        old_pages = manifest['pages']
+        if manifest['version'] != version:
+            # all the pages depend on the template and the menu
+            old_pages = {}
+        subjects = [_SYSTEM_LIST, _SYSTEM_WANTED]
+        for ns, stat_list in wiki.art_mgr.subjects().items():
+            if wiki.manager.recognizeNs(ns):
+                subjects.extend(stats.getSubject() for stats in stat_list)
+    finally:
+        wiki.close()
+
+    tasks = []
+    for subject in subjects:
+        if pagePath(subject) is None:
+            print >>sys.stderr, "(**) %s can't be published" % (subject,)
+            continue
+        tasks.append((out_dir, subject.getTitle(), subject.getNamespace(),
+                      old_pages.get(unicode(subject))))
+
+    if nb_jobs == 1:
+        _initWorker(db_name, template)
+        results = map(_publishArticle, tasks)
+    else:
+        pool = multiprocessing.Pool(nb_jobs, _initWorker, (db_name, template))
+        try:
+            results = list(pool.imap_unordered(_publishArticle, tasks, 16))
+        finally:
+            pool.close()
+            pool.join()
+
+    pages = {}
+    nb_rendered = 0
+    for subject_st, entry, rendered in results:
+        pages[subject_st] = entry
+        if rendered:
+            nb_rendered += 1
+    nb_removed = 0
+    for subject_st, entry in manifest['pages'].items():
+        if subject_st not in pages:
+            _removePage(out_dir, _entryPath(entry))
+            nb_removed += 1
+        elif _entryPath(pages[subject_st]) != _entryPath(entry):
+            # published by an older version
+            _removePage(out_dir, _entryPath(entry))
+
+    _copyStaticFiles(out_dir, stylesheet, img_dir)
+    f = open(manifest_path + '.tmp', 'wb')
+    try:
+        json.dump({'version': version, 'pages': pages}, f)
+    finally:
+        f.close()
+    os.rename(manifest_path + '.tmp', manifest_path)
+    return nb_rendered, len(pages) - nb_rendered, nb_removed
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] db_name site_dir")
+    parser.add_option('-f', '--force', dest='force', action='store_true',
+                      default=False, help="render all the pages again")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help="number of rendering processes"
+                           " (default: one per CPU)")
+    parser.add_option('-c', '--css', dest='css', default='css/wiki.css')
+    parser.add_option('-t', '--tmpl', dest='tmpl', default='template/wiki.tmpl')
+    parser.add_option('-i', '--img', dest='img', default='img',
+                      help="directory of the images")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("a database and a site directory are needed")
+
+    db_name, out_dir = args
+    rendered, up_to_date, removed = publish(db_name, out_dir, options.tmpl,
+                                            options.css, options.img,
+                                            options.jobs, options.force)
+    print "%d page(s) rendered, %d up to date, %d removed in %s" \
+          % (rendered, up_to_date, removed, out_dir)
+
+# End
@@ -0,0 +1,34 @@
+# db_render.py -
+#
+
+import sqldb
+import dbschema
+import sys
+
+import formatter
+import wikiparser
+import cache
+from pwiki import buildWikiManager
+
+if len(sys.argv) == 1 or len(sys.argv) > 3 \
+   or (len(sys.argv) == 3 and sys.argv[1] != '-f'):
+    print "USAGE: db_render.py [-f] db_name"
+    sys.exit(0)
+
+db_name = sys.argv[-1]
+is_forced = (len(sys.argv) == 3)
+
+db_conn = sqldb.connect(db_name)
+dbschema.migrate(db_conn)
+
+art_mgr = sqldb.SqlArticleManager(db_conn)
+wiki_manager = buildWikiManager(art_mgr)
+wiki_parser = wikiparser.WikiParser(formatter.HtmlBuilder(), wiki_manager)
+render_store = cache.RenderStore(art_mgr, wiki_manager, wiki_parser,
+                                 wikiparser.PARSER_VERSION)
+
+count = render_store.renderAll(is_forced)
+print "%d article(s) rendered in %s" % (count, db_name)
+db_conn.close()
+
+# End
@@ -0,0 +1,255 @@
+# dbschema.py - versioned schema of the wiki database
+#
+
+import wikiparser
+import sqlite3
+
+# number of rows written at once while a migration is prepared
+_BATCH_SIZE = 1000
+
+# Each migration brings the database from the previous version to its
+# version. A database created before the schema was versioned has the
+# version 1 (the tables of the articles, without schema_version table).
+MIGRATIONS = [
+    (1, "article tables", """
+CREATE TABLE article (
+    art_id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    art_title       TEXT,
+    art_ns          TEXT DEFAULT '',
+    art_ctime       TIMESTAMP,
+    art_mtime       TIMESTAMP
+);
+
+CREATE TABLE content (
+    art_id    INTEGER PRIMARY KEY,
+    cont_text BLOB,
+    cont_len  INTEGER DEFAULT 0
+);
+
+CREATE TABLE redirect (
+    art_id   INTEGER PRIMARY KEY,
+    rd_title TEXT,
+    rd_ns    TEXT
+);
+
+CREATE TABLE category (
+    cat_art_title TEXT,
+    art_id        INTEGER,
+    PRIMARY KEY (cat_art_title, art_id)
+);
+"""),
+    # the render tables may have been created before by db_render.py or by
+    # pwiki.py --render-on-write
+    (2, "rendered article tables", """
+CREATE TABLE IF NOT EXISTS render (
+    art_id       INTEGER PRIMARY KEY,
+    rend_version TEXT,
+    rend_mtime   TIMESTAMP,
+    rend_text    BLOB
+);
+
+CREATE TABLE IF NOT EXISTS render_link (
+    art_id   INTEGER,
+    rl_title TEXT,
+    rl_ns    TEXT,
+    PRIMARY KEY (art_id, rl_ns, rl_title)
+);
+
+CREATE INDEX IF NOT EXISTS render_link_target ON render_link (rl_ns, rl_title);
+"""),
+    (3, "article subject and lookup indexes", """
+CREATE UNIQUE INDEX article_subject ON article (art_ns, art_title);
+CREATE INDEX article_mtime ON article (art_mtime);
+CREATE INDEX category_article ON category (art_id);
+"""),
+    (4, "cascading article deletion", """
+CREATE TRIGGER article_delete AFTER DELETE ON article
+BEGIN
+    DELETE FROM content     WHERE art_id = OLD.art_id;
+    DELETE FROM redirect    WHERE art_id = OLD.art_id;
+    DELETE FROM category    WHERE art_id = OLD.art_id;
+    DELETE FROM render      WHERE art_id = OLD.art_id;
+    DELETE FROM render_link WHERE art_id = OLD.art_id;
+END;
+"""),
+    # the links of the existing articles are staged in migrate_link (see
+    # _stageArticleLinks)
+    (5, "article link table", """
+CREATE TABLE pagelinks (
+    pl_from  INTEGER,
+    pl_ns    TEXT,
+    pl_title TEXT,
+    PRIMARY KEY (pl_from, pl_ns, pl_title)
+);
+
+CREATE INDEX pagelinks_target ON pagelinks (pl_ns, pl_title);
+
+INSERT OR IGNORE INTO pagelinks
+SELECT art_id, rd_ns, rd_title
+FROM redirect;
+
+INSERT OR IGNORE INTO pagelinks
+SELECT art_id, ns, title
+FROM migrate_link;
+
+DROP TABLE migrate_link;
+
+DROP TRIGGER article_delete;
+
+CREATE TRIGGER article_delete AFTER DELETE ON article
+BEGIN
+    DELETE FROM content     WHERE art_id = OLD.art_id;
+    DELETE FROM redirect    WHERE art_id = OLD.art_id;
+    DELETE FROM category    WHERE art_id = OLD.art_id;
+    DELETE FROM render      WHERE art_id = OLD.art_id;
+    DELETE FROM render_link WHERE art_id = OLD.art_id;
+    DELETE FROM pagelinks   WHERE pl_from = OLD.art_id;
+END;
+"""),
+    (6, "article generation counter", """
+CREATE TABLE generation (
+    gen_value INTEGER
+);
+
+INSERT INTO generation
+    VALUES (0);
+
+CREATE TRIGGER generation_insert AFTER INSERT ON article
+BEGIN
+    UPDATE generation SET gen_value = gen_value + 1;
+END;
+
+CREATE TRIGGER generation_update AFTER UPDATE ON article
+BEGIN
+    UPDATE generation SET gen_value = gen_value + 1;
+END;
+
+CREATE TRIGGER generation_delete AFTER DELETE ON article
+BEGIN
+    UPDATE generation SET gen_value = gen_value + 1;
+END;
+"""),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _tableExists(connection, name):
+    cursor = connection.cursor()
+    cursor.execute("""
+SELECT COUNT(*)
+FROM sqlite_master
+WHERE type = 'table'
+  AND name = ?
+""", (name,))
+    result = int(cursor.fetchone()[0]) != 0
+    cursor.close()
+    return result
+
+def getSchemaVersion(connection):
+    """Get the schema version of a database (0 for an empty database).
+    """
+    if not _tableExists(connection, 'schema_version'):
+        if _tableExists(connection, 'article'):
+            return 1
+        return 0
+    cursor = connection.cursor()
+    cursor.execute("""
+SELECT MAX(version)
+FROM schema_version
+""")
+    version = cursor.fetchone()[0]
+    cursor.close()
+    if version is None:
+        return 0
+    return int(version)
+
+def getPendingMigrations(connection):
+    """Get the migrations not applied yet to a database.
+
+    @return: list of (version, description, script).
+    """
+    version = getSchemaVersion(connection)
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+def _stageArticleLinks(connection):
+    """Extract the links of the existing articles into the temporary table
+    migrate_link, read by the migration 5.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+CREATE TEMP TABLE IF NOT EXISTS migrate_link (
+    art_id INTEGER,
+    ns     TEXT,
+    title  TEXT
+)
+""")
+    cursor.execute("DELETE FROM migrate_link")
+    contents = connection.cursor()
+    contents.execute("""
+SELECT art_id, cont_text
+FROM content
+""")
+    rows = []
+    for art_id, content in contents:
+        if content is None:
+            continue
+        for link in wikiparser.extractLinks(content):
+            rows.append((art_id, link.getNamespace(), link.getTitle()))
+        if len(rows) >= _BATCH_SIZE:
+            cursor.executemany("""
+INSERT INTO migrate_link
+    VALUES (?, ?, ?)
+""", rows)
+            rows = []
+    cursor.executemany("""
+INSERT INTO migrate_link
+    VALUES (?, ?, ?)
+""", rows)
+    contents.close()
+    cursor.close()
+    connection.commit()
+
+# preparation of the migrations needing more than SQL, run before them
+_PREPARATIONS = {5: _stageArticleLinks}
+
+def migrate(connection):
+    """Bring a database to the current schema version.
+
+    Each migration is applied in its own transaction: if one fails, the
+    database stays at the version of the last successful one. The data a
+    migration computes in Python (such as the links of the articles) is
+    staged in temporary tables just before.
+
+    @return: the list of the applied migrations.
+    """
+    pending = getPendingMigrations(connection)
+    for version, description, script in pending:
+        if version in _PREPARATIONS:
+            _PREPARATIONS[version](connection)
+        cursor = connection.cursor()
+        try:
+            cursor.executescript("""
+BEGIN;
+CREATE TABLE IF NOT EXISTS schema_version (
+    version     INTEGER PRIMARY KEY,
+    description TEXT,
+    applied     TIMESTAMP
+);
+%s
+INSERT INTO schema_version
+    VALUES (%d, '%s', CURRENT_TIMESTAMP);
+COMMIT;
+""" % (script, version, description.replace("'", "''")))
+        except:
+            # the transaction of a script isn't known by the connection
+            try:
+                cursor.executescript("ROLLBACK;")
+            except sqlite3.OperationalError:
+                # the script failed outside of the transaction
+                pass
+            raise
+        finally:
+            cursor.close()
+    return pending
+
+# End
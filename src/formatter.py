@@ -26,15 +26,24 @@ def expandTabs(st, width=4):
     return st.replace('\t', u' ' * width)
 
 class RawOutput(object):
+    """Output of a formatter.
+    
+    The output is kept as a list of chunks, joined once by getRaw. The
+    output of a context is a chunk list itself: splicing it into its parent
+    context doesn't copy it, so that the rendering time stays linear in the
+    size of the output, whatever the nesting depth.
+    """
     def __init__(self, newline=u'\n', tablen=2):
-        # output of the current context
-        self.__output = u""
+        # chunks of the current context
+        self.__output = []
         # preceding contexts
         self.__context = []
         self.__newline = newline
         # tabulation length
         self.__tablen = tablen
         self.__indentSize = 0
+        # the output is in a preformatted element
+        self.__inPre = False
     
     def newline(self):
         self.append(self.__newline)
@@ -49,15 +58,33 @@ class RawOutput(object):
         self.__indentSize = self.__indentSize - 1
         assert self.__indentSize >= 0, "Bad indentation size"
     
+    def isInPre(self):
+        return self.__inPre
+    
+    def setInPre(self, in_pre):
+        self.__inPre = in_pre
+    
     def append(self, st):
-        self.__output += st
+        if len(st) > 0:
+            self.__output.append(st)
+    
+    def splice(self, chunks):
+        """Append the chunks of a popped context.
+        """
+        if len(chunks) > 0:
+            self.__output.append(chunks)
     
     def newContext(self, name):
         self.__context.append((name, self.__output))
-        self.__output = u""
+        self.__output = []
 #        print 'newContext():', self.__context, self.__output
     
     def popContext(self):
+        """Leave the current context.
+        
+        @return: the tuple (name, chunks) of the context, the chunk list
+        being empty if nothing has been output in it.
+        """
 #        print 'popContext():', self.__context, self.__output
         name, tmp = self.__context.pop()
         out = self.__output
@@ -66,9 +93,33 @@ class RawOutput(object):
     
     def getRaw(self):
         assert len(self.__context) == 0, "Context not empty"
-        return self.__output
+        chunks = []
+        # depth-first walk of the nested chunk lists
+        stack = [iter(self.__output)]
+        while len(stack) > 0:
+            for chunk in stack[-1]:
+                if isinstance(chunk, list):
+                    stack.append(iter(chunk))
+                    break
+                chunks.append(chunk)
+            else:
+                stack.pop()
+        return u''.join(chunks)
+    
+    def takeRaw(self):
+        """Get the output so far and empty it, the state of the output
+        (indentation, preformatted element) being kept.
+        """
+        raw = self.getRaw()
+        self.__output = []
+        return raw
 
 class HtmlBuilder(object):
+    """HTML formatter.
+    
+    The builder has no state of its own (it is kept by the RawOutput), so
+    that it can be shared by threads.
+    """
     pre_tag = u'pre'
     block_tags = (u'div', u'p',
                   u'ul', u'ol', u'li',
@@ -76,11 +127,8 @@ class HtmlBuilder(object):
                   u'h1', u'h2', u'h3', u'h4', u'h5', u'h6',
                   pre_tag)
     
-    def __init__(self):
-        self.__isInPre = False
-    
     def text(self, raw, content, attrs=None):
-        if self.__isInPre:
+        if raw.isInPre():
             raw.append(escape(content))
             return
         if len(content) == 0:
@@ -116,8 +164,9 @@ class HtmlBuilder(object):
         raw.newline()
     
     def startElement(self, raw, name, attrs={}):
-        self.__isInPre = self.__isInPre or (name == self.pre_tag)
-        if name in self.block_tags and self.__isInPre:
+        if name == self.pre_tag:
+            raw.setInPre(True)
+        if name in self.block_tags and raw.isInPre():
             raw.indent()
         raw.append(u"<" + name)
         if len(attrs) > 0:
@@ -140,12 +189,12 @@ class HtmlBuilder(object):
             raw.append(u">")
             if name in self.block_tags:
                 raw.newline()
-                if not self.__isInPre:
+                if not raw.isInPre():
                     raw.indent()
-            raw.append(out)
+            raw.splice(out)
             if name in self.block_tags:
                 raw.decrIndent()
-            if name in self.block_tags and not self.__isInPre:
+            if name in self.block_tags and not raw.isInPre():
                 raw.indent()
             if name in self.block_tags:
                 raw.newline()
@@ -158,7 +207,7 @@ class HtmlBuilder(object):
                 raw.newline()
                 raw.decrIndent()
         if name == self.pre_tag:
-            self.__isInPre = False
+            raw.setInPre(False)
 
 if __name__ == '__main__':
     raw = RawOutput()
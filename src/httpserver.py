@@ -0,0 +1,508 @@
+# httpserver.py -
+#
+
+import BaseHTTPServer
+import Queue
+import select
+import threading
+import os
+import signal
+import errno
+import asyncore
+import asynchat
+import socket
+import collections
+import cStringIO
+import re
+import time
+import sys
+import traceback
+
+# maximum size (in bytes) of the request line and headers
+MAX_HEADER_SIZE = 64 * 1024
+
+# maximum number of received requests waiting on a connection
+MAX_PENDING_REQUESTS = 16
+
+# time (in seconds) after which an idle kept-alive connection is closed
+KEEP_ALIVE_TIMEOUT = 15
+
+# maximum number of requests handled on a connection
+MAX_REQUESTS_PER_CONNECTION = 100
+
+# time (in seconds) between two checks for waiting clients while a worker
+# thread waits for the next request on a kept-alive connection
+KEEP_ALIVE_POLL_INTERVAL = 0.1
+
+_content_length_re = re.compile(r'^content-length:\s*(\d+)\s*$',
+                                re.IGNORECASE | re.MULTILINE)
+
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTP server handling the requests with a bounded pool of threads.
+
+    The accepted connections wait in a bounded queue for a free worker; when
+    the queue is full, the server stops accepting new connections. A worker
+    waiting for the next request on a kept-alive connection closes it as soon
+    as a connection is waiting in the queue (see
+    L{KeepAliveRequestHandler.waitNextRequest}).
+
+    @param nb_threads: number of worker threads.
+    @param queue_size: maximum number of connections waiting for a worker.
+    """
+    # several connections are handled at the same time
+    concurrent = True
+
+    def __init__(self, server_address, handler_cls, nb_threads, queue_size=None,
+                 bind_and_activate=True):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_cls,
+                                           bind_and_activate)
+        if queue_size is None:
+            queue_size = 8 * nb_threads
+        self.__requests = Queue.Queue(queue_size)
+        for i in range(nb_threads):
+            worker = threading.Thread(target=self.__work,
+                                      name='pwiki-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.__requests.put((request, client_address))
+
+    def __work(self):
+        while True:
+            request, client_address = self.__requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            self.__requests.task_done()
+
+    def hasWaitingConnections(self):
+        """Check if an accepted connection is waiting for a free worker.
+        """
+        return not self.__requests.empty()
+
+    def waitIdle(self):
+        """Wait until all the accepted connections are handled.
+        """
+        self.__requests.join()
+
+def serveUntilStopped(httpd, poll_interval=1.0):
+    """Serve until the process receives SIGTERM, then finish the pending
+    requests.
+    """
+    stopped = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.append(signum))
+    httpd.timeout = poll_interval
+    while not stopped:
+        httpd.handle_request()
+    if hasattr(httpd, 'waitIdle'):
+        httpd.waitIdle()
+    httpd.server_close()
+
+class PreforkSupervisor(object):
+    """Run and supervise worker processes.
+
+    The workers are forked from the supervisor; typically, they serve
+    requests from a listening socket opened before. The supervisor starts a
+    new worker each time one dies. On SIGHUP, the workers are gracefully
+    replaced: new workers are started and the old ones receive SIGTERM, so
+    that they stop after finishing their current requests. On SIGTERM or
+    SIGINT, all the workers are stopped.
+
+    @param nb_workers: number of worker processes.
+    @param serve: function run in each worker process.
+    """
+    # minimum time (in seconds) between two starts of a worker, to avoid
+    # restarting a worker failing at start up in a tight loop
+    RESTART_DELAY = 1.0
+
+    def __init__(self, nb_workers, serve):
+        self.__nbWorkers = nb_workers
+        self.__serve = serve
+        self.__workers = set()
+        self.__lastStart = 0.0
+        self.__running = False
+        self.__reload = False
+
+    def __spawn(self):
+        self.__lastStart = time.time()
+        pid = os.fork()
+        if pid != 0:
+            self.__workers.add(pid)
+            return
+        # worker process
+        status = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.__serve()
+        except:
+            traceback.print_exc(file=sys.stderr)
+            status = 1
+        os._exit(status)
+
+    def __stopWorkers(self, workers):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def __onStop(self, signum, frame):
+        self.__running = False
+
+    def __onReload(self, signum, frame):
+        self.__reload = True
+
+    def run(self):
+        self.__running = True
+        signal.signal(signal.SIGTERM, self.__onStop)
+        signal.signal(signal.SIGINT, self.__onStop)
+        signal.signal(signal.SIGHUP, self.__onReload)
+        while self.__running:
+            if self.__reload:
+                self.__reload = False
+                old_workers = self.__workers
+                self.__workers = set()
+                self.__stopWorkers(old_workers)
+            while self.__running and len(self.__workers) < self.__nbWorkers:
+                self.__spawn()
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.__workers:
+                self.__workers.discard(pid)
+                delay = self.__lastStart + self.RESTART_DELAY - time.time()
+                if self.__running and delay > 0:
+                    time.sleep(delay)
+        self.__stopWorkers(self.__workers)
+        while True:
+            try:
+                os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # no more child process
+                break
+
+class KeepAliveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP/1.1 request handler keeping the connections open.
+
+    The responses must all have a Content-Length header, a chunked body (see
+    sendChunks) or no body. A
+    connection is closed after KEEP_ALIVE_TIMEOUT seconds of inactivity or
+    MAX_REQUESTS_PER_CONNECTION requests. A server handling one connection at
+    a time, or a thread pool server with no free thread, also closes it
+    when it is idle and another client is waiting, so that a kept-alive
+    connection doesn't block the other clients.
+    """
+    protocol_version = "HTTP/1.1"
+
+    timeout = KEEP_ALIVE_TIMEOUT
+    max_requests = MAX_REQUESTS_PER_CONNECTION
+
+    # the headers and small responses are sent at once
+    wbufsize = -1
+
+    # number of requests received on the connection
+    requestCount = 0
+
+    def parse_request(self):
+        if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+            return False
+        self.requestCount += 1
+        return True
+
+    def end_headers(self):
+        if not self.close_connection and self.requestCount >= self.max_requests:
+            self.send_header("Connection", "close")
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+
+    def supportsChunks(self):
+        """Check if the client accepts a response with a chunked body.
+        """
+        return self.request_version == 'HTTP/1.1'
+
+    def sendChunks(self, chunks):
+        """Send the body of a response with the chunked transfer coding.
+
+        Each chunk is sent as soon as it is generated, so that the client
+        gets the start of the body while the rest is being built. The
+        response must have a "Transfer-Encoding: chunked" header.
+        """
+        for chunk in chunks:
+            if len(chunk) > 0:
+                self.wfile.write('%x\r\n' % len(chunk))
+                self.wfile.write(chunk)
+                self.wfile.write('\r\n')
+                self.wfile.flush()
+        self.wfile.write('0\r\n\r\n')
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.waitNextRequest():
+            self.handle_one_request()
+
+    def waitNextRequest(self):
+        """Wait for the next request on the connection.
+
+        @return: False if the connection must be closed instead.
+        @rtype: bool
+        """
+        # a pipelined request may already be buffered
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None and rbuf.tell() > 0:
+            return True
+        if getattr(self.server, 'concurrent', False):
+            return self.__waitConcurrent()
+        try:
+            readable = select.select([self.connection, self.server.socket],
+                                     [], [], self.timeout)[0]
+        except select.error:
+            return False
+        # the connection is only closed when it has nothing to read
+        return self.connection in readable
+
+    def __waitConcurrent(self):
+        # the thread handling the connection is given back to the server when
+        # another connection waits for a thread
+        has_waiting = getattr(self.server, 'hasWaitingConnections', None)
+        deadline = time.time() + self.timeout
+        while True:
+            delay = deadline - time.time()
+            if delay <= 0:
+                return False
+            try:
+                readable = select.select([self.connection], [], [],
+                                         min(delay, KEEP_ALIVE_POLL_INTERVAL))[0]
+            except select.error:
+                return False
+            if readable:
+                return True
+            if has_waiting is not None and has_waiting():
+                return False
+
+class BufferedRequestHandler:
+    """Mixin running a request handler on a request already received.
+
+    The request is a (data, count) pair: the data is a string holding the
+    request line, the headers and the body; count is the number of requests
+    received before on the connection. The response is kept in memory
+    instead of being written to a socket.
+    """
+    def setup(self):
+        self.connection = None
+        data, self.requestCount = self.request
+        self.rfile = cStringIO.StringIO(data)
+        self.wfile = cStringIO.StringIO()
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+    def getResponse(self):
+        return self.wfile.getvalue()
+
+def _socketpair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader, address = listener.accept()
+    finally:
+        listener.close()
+    return reader, writer
+
+class _Waker(asyncore.dispatcher):
+    """Call functions in the asyncore loop on behalf of other threads.
+    """
+    def __init__(self, channel_map):
+        reader, self.__writer = _socketpair()
+        # a full buffer already wakes the loop up: the callers don't wait
+        self.__writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader, channel_map)
+        self.__calls = collections.deque()
+
+    def call(self, func, *args):
+        self.__calls.append((func, args))
+        try:
+            self.__writer.send('x')
+        except socket.error:
+            # the buffer is full: the loop is already woken up
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        while self.__calls:
+            func, args = self.__calls.popleft()
+            func(*args)
+
+class _HTTPChannel(asynchat.async_chat):
+    """Connection of a client to an L{AsyncHTTPServer}.
+
+    The channel receives the requests, submits them one at a time to the
+    server workers and sends the responses back.
+    """
+    def __init__(self, server, sock, client_address, channel_map):
+        asynchat.async_chat.__init__(self, sock, channel_map)
+        self.__server = server
+        self.__clientAddress = client_address
+        self.__buffer = []
+        self.__bufferSize = 0
+        self.__head = None
+        self.__requests = collections.deque()
+        self.__requestCount = 0
+        self.__busy = False
+        self.__closing = False
+        self.__lastActivity = time.time()
+        self.set_terminator('\r\n\r\n')
+
+    def getClientAddress(self):
+        return self.__clientAddress
+
+    def isIdle(self, timeout):
+        return not self.__busy and len(self.__requests) == 0 \
+               and len(self.producer_fifo) == 0 \
+               and time.time() - self.__lastActivity > timeout
+
+    def readable(self):
+        return not self.__closing \
+               and len(self.__requests) < MAX_PENDING_REQUESTS \
+               and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.__lastActivity = time.time()
+        self.__buffer.append(data)
+        self.__bufferSize += len(data)
+        if self.__head is None and self.__bufferSize > MAX_HEADER_SIZE:
+            self.close()
+
+    def found_terminator(self):
+        data = ''.join(self.__buffer)
+        self.__buffer = []
+        self.__bufferSize = 0
+        if self.__head is None:
+            head = data + '\r\n\r\n'
+            if head.strip() == '':
+                # empty lines between requests
+                return
+            match = _content_length_re.search(head)
+            if match is not None and int(match.group(1)) > 0:
+                # read the body
+                self.__head = head
+                self.set_terminator(int(match.group(1)))
+                return
+            self.__requestReceived(head)
+        else:
+            self.__requestReceived(self.__head + data)
+            self.__head = None
+            self.set_terminator('\r\n\r\n')
+
+    def __requestReceived(self, request):
+        self.__requests.append(request)
+        self.__submit()
+
+    def __submit(self):
+        if not self.__busy and not self.__closing and self.__requests:
+            self.__busy = True
+            self.__server.submit(self, (self.__requests.popleft(),
+                                        self.__requestCount))
+            self.__requestCount += 1
+
+    def responseReady(self, response, close):
+        """Send a response back (called in the asyncore loop).
+        """
+        self.__busy = False
+        self.__lastActivity = time.time()
+        if not self.connected:
+            return
+        self.push(response)
+        if close:
+            self.__closing = True
+            self.close_when_done()
+        else:
+            self.__submit()
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """HTTP server doing the connection I/O in an asyncore loop.
+
+    Idle, slow and kept-alive connections are handled by the loop, without a
+    thread per connection. The received requests are handled by a pool of
+    worker threads, with a buffered version of the request handler class.
+
+    @param nb_threads: number of worker threads.
+    @param idle_timeout: time (in seconds) after which an idle connection is
+    closed.
+    """
+    def __init__(self, server_address, handler_cls, nb_threads,
+                 idle_timeout=KEEP_ALIVE_TIMEOUT):
+        self.__map = {}
+        asyncore.dispatcher.__init__(self, map=self.__map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(128)
+        class _BufferedHandler(BufferedRequestHandler, handler_cls):
+            pass
+        self.__handlerCls = _BufferedHandler
+        self.__idleTimeout = idle_timeout
+        self.__waker = _Waker(self.__map)
+        self.__jobs = Queue.Queue()
+        for i in range(nb_threads):
+            worker = threading.Thread(target=self.__work,
+                                      name='pwiki-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            _HTTPChannel(self, sock, client_address, self.__map)
+
+    def submit(self, channel, request):
+        self.__jobs.put((channel, request))
+
+    def __work(self):
+        while True:
+            channel, request = self.__jobs.get()
+            try:
+                handler = self.__handlerCls(request,
+                                            channel.getClientAddress(), self)
+                response, close = handler.getResponse(), handler.close_connection
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                response, close = '', True
+            self.__waker.call(channel.responseReady, response, close)
+
+    def __closeIdleChannels(self):
+        for channel in self.__map.values():
+            if isinstance(channel, _HTTPChannel) \
+               and channel.isIdle(self.__idleTimeout):
+                channel.close()
+
+    def serve_forever(self):
+        while True:
+            asyncore.loop(timeout=1.0, map=self.__map, count=1)
+            self.__closeIdleChannels()
+
+# End
@@ -4,6 +4,8 @@
 import article
 from wikiexc import WikiException
 
+import threading
+
 DEFAULT_NS  = u""         # Default namespace
 CATEGORY_NS = u"Category" # Category namespace
 IMAGE_NS    = u"Image"    # Image namespace
@@ -20,6 +22,9 @@ class UserNsManager(NamespaceManager):
     def contains(self, subject):
         return self.__art_mgr.contains(subject)
 
+    def filterExisting(self, subjects):
+        return self.__art_mgr.filterExisting(subjects)
+
     def get(self, subject):
         return self.__art_mgr.get(subject)
 
@@ -51,18 +56,37 @@ class SystemNsManager(NamespaceManager):
     def __init__(self, default_cb=_defaultCallback):
         self.__callbacks = {}
         self.__defaultcb = default_cb
+        # names of the callbacks handling the subpages of their page
+        self.__withSubpages = set()
     
-    def register(self, cb_name, cb):
+    def register(self, cb_name, cb, subpages=False):
+        """Register the callback of the page System:cb_name.
+
+        @param subpages: if True, the callback gets the subpages of the page
+        too (System:cb_name/...).
+        """
         self.__callbacks[cb_name] = cb
+        if subpages:
+            self.__withSubpages.add(cb_name)
+
+    def __getCallback(self, title):
+        if title not in self.__callbacks and u'/' in title:
+            title = title.split(u'/', 1)[0]
+            if title not in self.__withSubpages:
+                return None
+        return self.__callbacks.get(title)
 
     def contains(self, subject):
         return subject.getNamespace() == SYSTEM_NS \
-               and subject.getTitle() in self.__callbacks
+               and self.__getCallback(subject.getTitle()) is not None
 
     def get(self, subject):
         title = subject.getTitle()
         if subject.getNamespace() == SYSTEM_NS:
-            return self.__callbacks.get(title, self.__defaultcb)(subject)
+            cb = self.__getCallback(title)
+            if cb is None:
+                cb = self.__defaultcb
+            return cb(subject)
         else:
             raise WikiException, 'Bad system namespace ' + ns
 
@@ -82,14 +106,63 @@ class SystemNsManager(NamespaceManager):
     def count(self):
         return len(self.__callbacks)
 
+class ManagerListener(object):
+    """Get notified of the changes made through a L{WikiManager}.
+    """
+    def articleSet(self, subject, created):
+        """An article has been created (created is True) or modified.
+        """
+        pass
+
+    def articleDeleted(self, subject):
+        """An article has been deleted.
+        """
+        pass
+
+    def articlesReset(self):
+        """Any article may have changed (e.g. by another process).
+        """
+        pass
+
 class WikiManager(object):
     def __init__(self, art_mgr):
         self.__ns_mgr = {} # for System subjects
         self.__art_mgr = art_mgr
+        self.__listeners = []
+        # changes each time an article is set or deleted
+        self.__generation = 0
+        self.__generationLock = threading.Lock()
 
     def registerNsMgr(self, ns, ns_mgr):
         self.__ns_mgr[ns] = ns_mgr
 
+    def addListener(self, listener):
+        self.__listeners.append(listener)
+
+    def getGeneration(self):
+        """Get a number changing each time an article is set or deleted.
+
+        The generation of the article manager is used if it keeps one, so
+        that all the processes sharing the articles get the same numbers.
+        """
+        generation = self.__art_mgr.getGeneration()
+        if generation is None:
+            return self.__generation
+        return generation
+
+    def __nextGeneration(self):
+        with self.__generationLock:
+            self.__generation += 1
+
+    def sync(self):
+        """Take into account the changes made to the articles by other
+        processes, if any.
+        """
+        if self.__art_mgr.refresh():
+            self.__nextGeneration()
+            for listener in self.__listeners:
+                listener.articlesReset()
+
     def recognizeNs(self, ns):
         return ns in self.__ns_mgr
 
@@ -106,6 +179,20 @@ class WikiManager(object):
         #raise WikiException, 'No manager namespace ' + ns
         return False
 
+    def filterExisting(self, subjects):
+        # group the subjects by namespace manager, so that each manager
+        # checks all its subjects at once
+        groups = {}
+        for subject in subjects:
+            ns = subject.getNamespace()
+            if ns in self.__ns_mgr:
+                ns_mgr = self.__ns_mgr[ns]
+                groups.setdefault(id(ns_mgr), (ns_mgr, []))[1].append(subject)
+        existing = set()
+        for ns_mgr, ns_subjects in groups.values():
+            existing.update(ns_mgr.filterExisting(ns_subjects))
+        return existing
+
     def get(self, subject):
         ns = subject.getNamespace()
         if ns in self.__ns_mgr:
@@ -118,7 +205,11 @@ class WikiManager(object):
         ns = subject.getNamespace()
         if ns in self.__ns_mgr:
             ns_mgr = self.__ns_mgr[ns]
+            created = not ns_mgr.contains(subject)
             ns_mgr.set(art)
+            self.__nextGeneration()
+            for listener in self.__listeners:
+                listener.articleSet(subject, created)
         else:
             raise WikiException, 'No manager namespace ' + ns
 
@@ -127,6 +218,9 @@ class WikiManager(object):
         if ns in self.__ns_mgr:
             ns_mgr = self.__ns_mgr[ns]
             ns_mgr.delete(subject)
+            self.__nextGeneration()
+            for listener in self.__listeners:
+                listener.articleDeleted(subject)
         else:
             raise WikiException, 'No manager namespace ' + ns
 
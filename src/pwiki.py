@@ -9,11 +9,19 @@ import wikipage
 import formatter
 import wikiparser
 import article
+import cache
+import subjindex
+import static
+import httpserver
 
 import urllib
 import sys, os
 import shutil
 import re
+import hashlib
+import gzip
+import zlib
+import cStringIO
 
 WIKI_NAME = "Pwiki"
 
@@ -25,6 +33,7 @@ __copyright__ = "%s %s - Copyright (C) Francois Sarradin, 2011" \
 #wiki_articledb = articledb.DummyArticleDb()
 import sqlite3
 import sqldb
+import dbschema
 
 wiki_connection = None
 wiki_artmgr = None
@@ -33,12 +42,69 @@ wiki_manager = None
 
 wiki_stylesheet = None
 
+wiki_static = static.StaticFileCache()
+
+# how long (in seconds) the browsers can keep the static files
+STATIC_MAX_AGE = 3600
+
+# content types sent compressed to the clients accepting it
+COMPRESSIBLE_TYPES = ('text/html', 'text/css')
+
+# minimum size (in bytes) of a compressed content, None to never compress
+wiki_compress_min_size = None
+
+# compressed contents of the tagged responses: (etag, encoding) -> content
+wiki_compressed = cache.LRUCache(4 * 1024 * 1024)
+
+# check the changes made by other processes at each request
+wiki_sync = False
+
+def compress(content, encoding):
+    """Compress a content according to an HTTP content coding.
+    """
+    if encoding == 'gzip':
+        buf = cStringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return buf.getvalue()
+    return zlib.compress(content)
+
+def iterCompress(chunks, encoding):
+    """Compress a content generated piece by piece according to an HTTP
+    content coding.
+
+    Each piece is flushed once compressed, so that the client can decode
+    the start of the content while the rest is being built.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj()
+    for chunk in chunks:
+        if len(chunk) > 0:
+            yield compressor.compress(chunk) \
+                  + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def weakETag(etag):
+    """Get the weak version of an entity tag, shared by all the content
+    codings of a response.
+    """
+    if etag.startswith('W/'):
+        return etag
+    return 'W/' + etag
+
 page_factory = None
 
 class SystemList(manager.SystemCallback):
-    def __init__(self, subject, art_mgr):
+    def __init__(self, subject, art_mgr, editable=True):
         self.__art_mgr = art_mgr
         self.__subject = subject
+        self.__editable = editable
 
     def __getParagraph(self, ns_name, stat_list):
         content = u''
@@ -49,7 +115,8 @@ class SystemList(manager.SystemCallback):
             if title == '':
                 title = '(Home)'
             content += """<li class="system-list">"""
-            if stats.getSubject().getNamespace() != manager.SYSTEM_NS:
+            if self.__editable \
+               and stats.getSubject().getNamespace() != manager.SYSTEM_NS:
                 content += """
   <span style="font-size: x-small;">
     (<a href="/%(link)s?action=edit" title="&Eacute;diter %(title)s">edit</a>)
@@ -107,7 +174,129 @@ class SystemList(manager.SystemCallback):
                                            subjects[manager.SYSTEM_NS])
         return article.SystemArticle(self.__subject, content)
 
-class PwikiHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+def _subjectLink(subject, link_cls):
+    title = unicode(subject)
+    if title == '':
+        title = '(Home)'
+    return """<a class="%(cls)s" href="/%(link)s" title="%(title)s">%(title)s</a>""" \
+           % {'cls': link_cls, 'link': formatter.escape(unicode(subject), True),
+              'title': formatter.escape(title, True)}
+
+class SystemLinksHere(manager.SystemCallback):
+    """Page of the articles linking to a subject
+    (System:WhatLinksHere/Subject).
+
+    @param art_mgr: a L{sqldb.SqlArticleManager}.
+    """
+    def __init__(self, art_mgr, wiki_manager):
+        self.__art_mgr = art_mgr
+        self.__manager = wiki_manager
+
+    def __getItem(self, stats):
+        content = """<li class="system-list">%s""" \
+                  % _subjectLink(stats.getSubject(), "wiki-defined")
+        if stats.isRedirect():
+            content += """ <span style="color: gray; font-size: small;">(redirection)</span>"""
+        return content + '</li>\n'
+
+    def __call__(self, subject):
+        title = subject.getTitle()
+        if u'/' not in title:
+            return article.SystemArticle(subject, """\
+<p>The articles linking to a subject are listed by the page
+<tt>System:WhatLinksHere/Subject</tt>, reached by the <em>links</em> tab of
+the subject.</p>
+""")
+        target = article.Subject.fromString(title.split(u'/', 1)[1])
+        link_cls = "wiki-undefined"
+        if self.__manager.contains(target):
+            link_cls = "wiki-defined"
+        linking = self.__art_mgr.getLinksTo(target)
+        content = "<h2>Links to " + _subjectLink(target, link_cls) \
+                  + ' <span style="font-weight: normal; color: gray; font-size: small;">[' \
+                  + unicode(len(linking)) + " article(s)]</span></h2>\n<ul>\n"
+        for stats in linking:
+            content += self.__getItem(stats)
+        content += '</ul>\n'
+        # the articles including a template which links to the subject
+        direct = set(stats.getSubject() for stats in linking)
+        indirect = sorted((dependent for dependent
+                           in self.__art_mgr.getDependents(target)
+                           if dependent not in direct),
+                          key=lambda dependent: (dependent.getNamespace(),
+                                                 dependent.getTitle()))
+        if len(indirect) > 0:
+            content += "<h2>Through templates</h2>\n<ul>\n"
+            for dependent in indirect:
+                content += """<li class="system-list">%s</li>\n""" \
+                           % _subjectLink(dependent, "wiki-defined")
+            content += '</ul>\n'
+        return article.SystemArticle(subject, content)
+
+class SystemWanted(manager.SystemCallback):
+    """Page of the subjects linked to which don't exist yet
+    (System:Wanted), the most linked first.
+
+    @param art_mgr: a L{sqldb.SqlArticleManager}.
+    @param max_subjects: maximum number of listed subjects.
+    """
+    def __init__(self, subject, art_mgr, wiki_manager, max_subjects=500):
+        self.__subject = subject
+        self.__art_mgr = art_mgr
+        self.__manager = wiki_manager
+        self.__maxSubjects = max_subjects
+
+    def __call__(self, subject):
+        wanted = [(wanted_subject, count) for wanted_subject, count
+                  in self.__art_mgr.getWantedSubjects(self.__maxSubjects)
+                  if wanted_subject.getNamespace() != manager.SYSTEM_NS]
+        has_links_page = self.__manager.contains(
+            article.Subject(u'WhatLinksHere', manager.SYSTEM_NS))
+        content = ""
+        for wanted_subject, count in wanted:
+            content += """<li class="system-list">%s .&nbsp;.
+  <span style="color: gray; font-size: small;">""" \
+                       % _subjectLink(wanted_subject, "wiki-undefined")
+            if has_links_page:
+                content += """<a href="/System:WhatLinksHere/%s">[%d link(s)]</a>""" \
+                           % (formatter.escape(unicode(wanted_subject), True),
+                              count)
+            else:
+                content += "[%d link(s)]" % count
+            content += "</span></li>\n"
+        content = "<h2>Wanted articles" \
+                  + ' <span style="font-weight: normal; color: gray; font-size: small;">[' \
+                  + unicode(len(wanted)) + " article(s)]</span></h2>\n<ul>\n" \
+                  + content
+        return article.SystemArticle(self.__subject, content + '</ul>\n')
+
+def buildWikiManager(art_mgr, links_page=True, editable=True):
+    """Build the wiki manager handling all the namespaces of the wiki.
+
+    @param links_page: if False, the pages of the articles linking to each
+    subject (System:WhatLinksHere/Subject) are not available.
+    @param editable: if False, the list of the articles has no edit and
+    delete links.
+    """
+    wiki_manager = manager.WikiManager(art_mgr)
+    userNsMgr = manager.UserNsManager(art_mgr)
+    systemNsMgr = manager.SystemNsManager()
+    _systemList = SystemList(article.Subject('List', manager.SYSTEM_NS),
+                             wiki_manager, editable)
+    systemNsMgr.register('List', _systemList)
+    _systemWanted = SystemWanted(article.Subject('Wanted', manager.SYSTEM_NS),
+                                 art_mgr, wiki_manager)
+    systemNsMgr.register('Wanted', _systemWanted)
+    if links_page:
+        systemNsMgr.register('WhatLinksHere',
+                             SystemLinksHere(art_mgr, wiki_manager), True)
+    wiki_manager.registerNsMgr(manager.DEFAULT_NS, userNsMgr)
+    wiki_manager.registerNsMgr(manager.CATEGORY_NS, userNsMgr)
+    wiki_manager.registerNsMgr(manager.TEMPLATE_NS, userNsMgr)
+    wiki_manager.registerNsMgr(manager.SYSTEM_NS, systemNsMgr)
+    return wiki_manager
+
+class PwikiHTTPRequestHandler(httpserver.KeepAliveRequestHandler):
     """Pwiki HTTP request handler.
     
     This is an Adapter for MyWikiRequestHandler.
@@ -169,61 +358,224 @@ class PwikiHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         
         return parameters
 
-    def sendError(self, code, title, message):
-        webpage = page_factory.buildErrorPage(title, message)
-        content = webpage.getHtml('UTF-8')
-        content_type = 'text/html'
-        content_length = len(content)
+    def getContentEncoding(self, content_type, size=None):
+        """Get the content coding to use for a response, or None.
 
+        The coding is chosen among the ones accepted by the client. The
+        contents smaller than the minimum size are not compressed.
+        """
+        if wiki_compress_min_size is None \
+           or content_type not in COMPRESSIBLE_TYPES:
+            return None
+        if size is not None and size < wiki_compress_min_size:
+            return None
+        accept_encoding = self.headers.getheader('accept-encoding')
+        if accept_encoding is None:
+            return None
+        accepted = []
+        for item in accept_encoding.split(','):
+            params = item.split(';')
+            coding = params[0].strip().lower()
+            qvalue = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            if qvalue > 0:
+                accepted.append(coding)
+        for coding in ('gzip', 'deflate'):
+            if coding in accepted:
+                return coding
+        return None
+
+    def sendContent(self, code, content_type, content, headers=(), etag=None):
+        """Send a response, compressed if the client accepts it.
+
+        The compressed contents of the tagged responses are kept, so that
+        the same content isn't compressed again.
+        """
+        encoding = self.getContentEncoding(content_type, len(content))
+        if encoding is not None:
+            compressed = None
+            if etag is not None:
+                compressed = wiki_compressed.get((etag, encoding))
+            if compressed is None:
+                compressed = compress(content, encoding)
+                if etag is not None:
+                    wiki_compressed.put((etag, encoding), compressed)
+            content = compressed
+        self.sendRawContent(code, content_type, content, encoding, headers, etag)
+
+    def sendCompressedContent(self, content_type, etag, headers=()):
+        """Send a kept compressed content, if any.
+
+        @return: False if there is no content to send.
+        """
+        encoding = self.getContentEncoding(content_type)
+        if encoding is None:
+            return False
+        content = wiki_compressed.get((etag, encoding))
+        if content is None:
+            return False
+        self.sendRawContent(200, content_type, content, encoding, headers, etag)
+        return True
+
+    def sendRawContent(self, code, content_type, content, encoding, headers, etag):
         self.send_response(code)
         self.send_header("Content-type", content_type)
-        self.send_header("Content-Length", content_length)
+        self.send_header("Content-Length", len(content))
+        if content_type in COMPRESSIBLE_TYPES and wiki_compress_min_size is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if etag is not None:
+            if encoding is not None:
+                etag = weakETag(etag)
+            self.send_header("ETag", etag)
+        for name, value in headers:
+            self.send_header(name, value)
         self.end_headers()
 
         self.wfile.write(content)
 
-    def sendWebPage(self, webpage):
-        content = webpage.getHtml('UTF-8')
-        content_type = 'text/html'
-        content_length = len(content)
+    def sendRedirect(self, location):
+        self.send_response(301)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def sendError(self, code, title, message):
+        webpage = page_factory.buildErrorPage(title, message)
+        self.sendContent(code, 'text/html', webpage.getHtml('UTF-8'))
 
+    def sendWebPage(self, webpage, etag=None):
+        """Send a page, streamed to the HTTP/1.1 clients.
+
+        A streamed page is compressed piece by piece, if the client accepts
+        it; the compressed content of a tagged page is then kept.
+        """
+        headers = ()
+        if etag is not None:
+            headers = [("Cache-Control", "no-cache")]
+        if not self.supportsChunks():
+            self.sendContent(200, 'text/html', webpage.getHtml('UTF-8'),
+                             headers, etag)
+            return
+        encoding = self.getContentEncoding('text/html')
         self.send_response(200)
-        self.send_header("Content-type", content_type)
-        self.send_header("Content-Length", content_length)
+        self.send_header("Content-type", 'text/html')
+        self.send_header("Transfer-Encoding", "chunked")
+        if wiki_compress_min_size is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if etag is not None:
+            if encoding is not None:
+                self.send_header("ETag", weakETag(etag))
+            else:
+                self.send_header("ETag", etag)
+        for name, value in headers:
+            self.send_header(name, value)
         self.end_headers()
+        chunks = webpage.iterHtml('UTF-8')
+        if encoding is None:
+            self.sendChunks(chunks)
+            return
+        chunks = iterCompress(chunks, encoding)
+        if etag is None:
+            self.sendChunks(chunks)
+            return
+        compressed = []
+        def keepChunks(chunks):
+            for chunk in chunks:
+                compressed.append(chunk)
+                yield chunk
+        self.sendChunks(keepChunks(chunks))
+        wiki_compressed.put((etag, encoding), ''.join(compressed))
+
+    def isNotModified(self, etag, mtime=None):
+        """Check if the client already has the current version of a resource.
+        """
+        if_none_match = self.headers.getheader('if-none-match')
+        if if_none_match is not None:
+            # weak comparison: the compressed responses have weak tags
+            etags = [weakETag(tag.strip()) for tag in if_none_match.split(',')]
+            return '*' in etags or weakETag(etag) in etags
+        if_modified_since = self.headers.getheader('if-modified-since')
+        if if_modified_since is not None and mtime is not None:
+            since = static.parseHttpDate(if_modified_since.split(';')[0])
+            return since is not None and mtime <= since
+        return False
+
+    def sendStaticFile(self, static_file):
+        cache_headers = [("Last-Modified",
+                          static.httpDate(static_file.getModificationTime())),
+                         ("Cache-Control", "max-age=%d" % STATIC_MAX_AGE)]
+        etag = static_file.getETag()
+        if self.isNotModified(etag, static_file.getModificationTime()):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            for name, value in cache_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            return
 
-        self.wfile.write(content)
-
-    def sendStylesheet(self):
-        f  = open(wiki_stylesheet, 'r')
-        content = f.read()
-        f.close()
-        content_type = 'text/css'
-        content_length = len(content)
+        content = static_file.getContent()
+        if content is not None:
+            self.sendContent(200, static_file.getContentType(), content,
+                             cache_headers, etag)
+            return
 
         self.send_response(200)
-        self.send_header("Content-type", content_type)
-        self.send_header("Content-Length", content_length)
+        self.send_header("Content-type", static_file.getContentType())
+        self.send_header("Content-Length", str(static_file.getSize()))
+        self.send_header("ETag", etag)
+        for name, value in cache_headers:
+            self.send_header(name, value)
         self.end_headers()
+        self.sendFile(static_file.getPath(), static_file.getSize())
 
-        self.wfile.write(content)
+    def sendFile(self, path, size):
+        """Send the content of a file not kept in memory.
+        """
+        f = open(path, 'rb')
+        try:
+            sendfile = getattr(os, 'sendfile', None)
+            if sendfile is None or self.connection is None:
+                shutil.copyfileobj(f, self.wfile)
+                return
+            # let the kernel copy the file into the socket
+            self.wfile.flush()
+            offset = 0
+            while offset < size:
+                sent = sendfile(self.connection.fileno(), f.fileno(),
+                                offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        finally:
+            f.close()
+
+    def sendStylesheet(self):
+        static_file = wiki_static.get(wiki_stylesheet, 'text/css')
+        if static_file is None:
+            self.send_error(404, "File not found")
+            return
+        self.sendStaticFile(static_file)
 
     def sendImage(self, filename):
+        if filename is None or os.path.basename(filename) != filename:
+            self.send_error(404, "File not found")
+            return
         img_type = 'image/' + filename.rsplit('.', 1)[-1]
-        path = 'img/' + filename
-        try:
-            f = open(path, 'rb')
-        except IOError:
+        static_file = wiki_static.get('img/' + filename, img_type)
+        if static_file is None:
             self.send_error(404, "File not found")
             return
-        
-        fs = os.fstat(f.fileno())
-        self.send_response(200)
-        self.send_header("Content-type", img_type)
-        self.send_header("Content-Length", str(fs[6]))
-        self.end_headers()
-        shutil.copyfileobj(f, self.wfile)
-        f.close()
+        self.sendStaticFile(static_file)
 
     def __getArticle(self, subject, action):
         article_acquire = False
@@ -248,14 +600,51 @@ class PwikiHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             action = 'consult'
         return subject, art, action
     
-    def buildWebPage(self, subject, action):
+    def getArticleETag(self, art):
+        """Get the entity tag of the consultation page of an article.
+
+        The tag depends on the article modification time, the page template
+        and menu versions, the stylesheet, the wiki and parser versions and
+        the generation of the wiki manager, which changes each time an
+        article is created, modified or deleted (link classes and category
+        members depend on other articles). It is kept in the database, so
+        that all the workers and runs of the server give the same tags. Get
+        None for pages which can't be tagged.
+        """
+        mtime = art.getModificationTime()
+        if mtime is None:
+            return None
+        css_tag = None
+        static_file = wiki_static.get(wiki_stylesheet, 'text/css')
+        if static_file is not None:
+            css_tag = static_file.getETag()
+        key = u'|'.join(unicode(elem) for elem in (
+            art.getSubject(), mtime, page_factory.getVersion(), css_tag,
+            __version__, wikiparser.PARSER_VERSION,
+            wiki_manager.getGeneration()))
+        return '"%s"' % hashlib.md5(key.encode('utf8')).hexdigest()
+
+    def sendArticlePage(self, subject, action):
+        """Send the consultation or edition page of an article.
+
+        A consultation page is tagged, so that a client sending back the tag
+        of the current version gets a 304 without the page being built.
+        """
         subject, wiki_article, action = self.__getArticle(subject, action)
-
-        # action is only one 'consult' or 'edit'
         if action == 'consult':
-            return page_factory.buildConsultPage(wiki_article)
+            etag = self.getArticleETag(wiki_article)
+            if etag is not None and self.isNotModified(etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                return
+            if etag is not None and self.sendCompressedContent(
+                    'text/html', etag, [("Cache-Control", "no-cache")]):
+                return
+            self.sendWebPage(page_factory.buildConsultPage(wiki_article), etag)
         else:
-            return page_factory.buildEditPage(wiki_article)
+            self.sendWebPage(page_factory.buildEditPage(wiki_article))
 
     def __buildArticle(self, subject, content):
         def matchRedirect(content):
@@ -289,7 +678,14 @@ class PwikiHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """
         # check authorisations
         if not self.isAuthorized(self.client_address):
-            self.sendError(403, self.response[403][0], self.response[403][1])
+            # the request body isn't read
+            self.close_connection = 1
+            self.sendError(403, self.responses[403][0], self.responses[403][1])
+            return
+
+        if wiki_sync:
+            # take the changes made by the other processes into account
+            wiki_manager.sync()
 
         parameters = self.getParameters()
         if 'getcss' in parameters:
@@ -311,34 +707,25 @@ class PwikiHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         if action in ['consult', 'edit']:
             # client wants to consult or edit an article
-            webpage = self.buildWebPage(subject, action)
-            self.sendWebPage(webpage)
+            self.sendArticlePage(subject, action)
             
         elif action == 'modify':
             # client wants to modify an article
             if 'content' in parameters and subject.getNamespace() != manager.SYSTEM_NS:
                 art = self.__buildArticle(subject, parameters['content'])
                 wiki_manager.set(art)
-            self.send_response(301)
-            self.send_header("Location",'/' \
-                             + urllib.quote(unicode(subject).encode('utf8')))
-            self.end_headers()
+            self.sendRedirect('/' + urllib.quote(unicode(subject).encode('utf8')))
             
         elif action == 'delete':
             # client wants to delete an article
             if subject.getNamespace() != manager.SYSTEM_NS:
                 wiki_manager.delete(subject)
             # send the client to the system list page
-            self.send_response(301)
-            self.send_header("Location", '/System:List')
-            self.end_headers()
+            self.sendRedirect('/System:List')
             
         else:
             # unknown action
-            self.send_response(301)
-            self.send_header("Location",'/' \
-                             + urllib.quote(unicode(subject).encode('utf8')))
-            self.end_headers()
+            self.sendRedirect('/' + urllib.quote(unicode(subject).encode('utf8')))
 
     def do_GET(self):
         self.handleWikiRequest()
@@ -346,6 +733,116 @@ class PwikiHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_POST(self):
         self.handleWikiRequest()
 
+def connect(options):
+    mmap_size = None
+    if options.mmap_size is not None:
+        mmap_size = int(options.mmap_size) * 1024 * 1024
+    return sqldb.connect(options.db, journal_mode=options.journal_mode,
+                         synchronous=options.synchronous,
+                         cache_size=options.cache_size, mmap_size=mmap_size,
+                         temp_store=options.temp_store,
+                         busy_timeout=int(options.busy_timeout))
+
+def migrateDb(connection):
+    """Bring the database schema up to date (or create it in memory).
+    """
+    for version, description, script in dbschema.migrate(connection):
+        print "Database migrated to version %d: %s" % (version, description)
+
+def prepareDb(options):
+    """Prepare the database before serving the wiki.
+    """
+    connection = connect(options)
+    try:
+        migrateDb(connection)
+        art_mgr = sqldb.SqlArticleManager(connection)
+        wikipage.WikiPageFactory(WIKI_NAME, __copyright__, None, None,
+                                 buildWikiManager(art_mgr), None).seedMenu()
+    finally:
+        connection.close()
+
+def setupWiki(options, nb_threads=0, sync=False):
+    """Set up the database connection, the managers and the page factory of
+    this process.
+
+    @param nb_threads: number of threads handling the requests.
+    @param sync: if True, the caches are checked at each request against
+    the changes made by the other processes.
+    """
+    global wiki_connection, wiki_artmgr, wiki_manager, wiki_stylesheet, \
+           wiki_compress_min_size, wiki_sync, page_factory
+
+    wiki_stylesheet = options.css
+    if options.gzip:
+        wiki_compress_min_size = int(options.gzip_min_size)
+    wiki_sync = sync
+
+    if nb_threads > 0:
+        # each thread has its own connection
+        wiki_connection = sqldb.ThreadLocalConnection(lambda: connect(options))
+    else:
+        wiki_connection = connect(options)
+    migrateDb(wiki_connection)
+
+    wiki_index = None
+    if options.index == 'set':
+        wiki_index = subjindex.SubjectIndex()
+    elif options.index == 'bloom':
+        wiki_index = subjindex.BloomSubjectIndex()
+    wiki_artmgr = sqldb.SqlArticleManager(wiki_connection, wiki_index)
+
+    wiki_manager = buildWikiManager(wiki_artmgr)
+
+    render_cache = None
+    if int(options.render_cache) > 0:
+        render_cache = cache.RenderCache(int(options.render_cache) * 1024)
+        wiki_manager.addListener(render_cache)
+
+    # the parser is shared by the threads
+    wiki_formatter = formatter.HtmlBuilder()
+    wiki_parser = wikiparser.WikiParser(wiki_formatter, wiki_manager,
+                                        int(options.block_cache) * 1024,
+                                        int(options.template_cache) * 1024)
+    # the expanded templates are dropped before the pages are rendered again
+    wiki_manager.addListener(wiki_parser.getTemplateExpander())
+
+    render_store = None
+    if options.render_on_write:
+        render_store = cache.RenderStore(wiki_artmgr, wiki_manager,
+                                         wiki_parser, wikiparser.PARSER_VERSION)
+        wiki_manager.addListener(render_store)
+
+    page_factory = wikipage.WikiPageFactory(WIKI_NAME, __copyright__,
+                                            wiki_parser, wiki_formatter,
+                                            wiki_manager, options.tmpl,
+                                            render_cache, render_store)
+    wiki_manager.addListener(page_factory)
+    page_factory.seedMenu()
+
+def createServer(server_address, nb_threads=0, async_io=False, listener=None):
+    """Create the HTTP server of this process.
+
+    @param listener: listening socket to use instead of binding a new one.
+    """
+    if async_io:
+        return httpserver.AsyncHTTPServer(server_address,
+                                          PwikiHTTPRequestHandler,
+                                          nb_threads)
+    if nb_threads > 0:
+        httpd = httpserver.ThreadPoolHTTPServer(server_address,
+                                                PwikiHTTPRequestHandler,
+                                                nb_threads,
+                                                bind_and_activate=listener is None)
+    else:
+        httpd = BaseHTTPServer.HTTPServer(server_address,
+                                          PwikiHTTPRequestHandler,
+                                          bind_and_activate=listener is None)
+    if listener is not None:
+        httpd.socket.close()
+        httpd.socket = listener
+        httpd.server_address = listener.getsockname()
+    return httpd
+
 if __name__ == '__main__':
     TEST = False
     
@@ -357,46 +854,112 @@ if __name__ == '__main__':
         DEFAULT_DB = ':memory:'
     DEFAULT_CSS = 'css/wiki.css'
     DEFAULT_TEMPLATE = 'template/wiki.tmpl'
+    DEFAULT_RENDER_CACHE = 4096 # in K characters
+    DEFAULT_BLOCK_CACHE = 1024 # in K characters
+    DEFAULT_TEMPLATE_CACHE = 1024 # in K characters
+    DEFAULT_INDEX = 'set'
+    DEFAULT_GZIP_MIN_SIZE = 1024
+    DEFAULT_JOURNAL_MODE = 'wal'
+    DEFAULT_SYNCHRONOUS = 'normal'
     
     parser = optparse.OptionParser()
     parser.add_option('-p', '--port', dest='port', default=DEFAULT_PORT)
     parser.add_option('-d', '--db', dest='db', default=DEFAULT_DB)
     parser.add_option('-c', '--css', dest='css', default=DEFAULT_CSS)
     parser.add_option('-t', '--tmpl', dest='tmpl', default=DEFAULT_TEMPLATE)
+    parser.add_option('-r', '--render-cache', dest='render_cache',
+                      default=DEFAULT_RENDER_CACHE,
+                      help="size of the rendered article cache in K characters"
+                           " (0 to disable)")
+    parser.add_option('-b', '--block-cache', dest='block_cache',
+                      default=DEFAULT_BLOCK_CACHE,
+                      help="size of the rendered block cache in K characters"
+                           " (0 to disable)")
+    parser.add_option('-T', '--template-cache', dest='template_cache',
+                      default=DEFAULT_TEMPLATE_CACHE,
+                      help="size of the expanded template cache in K"
+                           " characters (0 to disable)")
+    parser.add_option('-w', '--render-on-write', dest='render_on_write',
+                      action='store_true', default=False,
+                      help="render the articles when they are saved and store"
+                           " the result in the database")
+    parser.add_option('-i', '--index', dest='index', default=DEFAULT_INDEX,
+                      type='choice', choices=['set', 'bloom', 'none'],
+                      help="in-memory index of the existing subjects:"
+                           " set (exact), bloom (compact) or none")
+    parser.add_option('-z', '--gzip-min-size', dest='gzip_min_size',
+                      default=DEFAULT_GZIP_MIN_SIZE,
+                      help="minimum size in bytes of the compressed responses")
+    parser.add_option('--no-gzip', dest='gzip', action='store_false',
+                      default=True, help="never compress the responses")
+    parser.add_option('-n', '--threads', dest='threads', default=0,
+                      help="number of threads handling the requests"
+                           " (0 to handle them in the main thread)")
+    parser.add_option('-W', '--workers', dest='workers', default=0,
+                      help="number of pre-forked worker processes"
+                           " (0 to serve in this process)")
+    parser.add_option('-a', '--async', dest='async_io', action='store_true',
+                      default=False,
+                      help="handle the connections in an asyncore loop, and"
+                           " the requests in the threads (4 by default)")
+    storage = optparse.OptionGroup(parser, "Storage options",
+                                   "Tuning of the SQLite database connections.")
+    storage.add_option('--journal-mode', dest='journal_mode',
+                       default=DEFAULT_JOURNAL_MODE, type='choice',
+                       choices=sqldb.JOURNAL_MODES,
+                       help="journal mode of the database; in wal mode, the"
+                            " readers don't wait for the writers"
+                            " [default: %default]")
+    storage.add_option('--synchronous', dest='synchronous',
+                       default=DEFAULT_SYNCHRONOUS, type='choice',
+                       choices=sqldb.SYNCHRONOUS_MODES,
+                       help="synchronization of the writes with the disk"
+                            " [default: %default]")
+    storage.add_option('--cache-size', dest='cache_size', type='int',
+                       help="page cache size of each connection in KiB")
+    storage.add_option('--mmap-size', dest='mmap_size', type='int',
+                       help="size of the memory-mapped database in MiB")
+    storage.add_option('--temp-store', dest='temp_store', type='choice',
+                       choices=sqldb.TEMP_STORES,
+                       help="storage of the temporary tables and indices")
+    storage.add_option('--busy-timeout', dest='busy_timeout',
+                       default=sqldb.DEFAULT_BUSY_TIMEOUT, type='int',
+                       help="time in milliseconds waiting for a locked"
+                            " database [default: %default]")
+    parser.add_option_group(storage)
     (options, args) = parser.parse_args()
-    
-    wiki_stylesheet = options.css
 
-    wiki_connection = sqlite3.connect(options.db, isolation_level="IMMEDIATE")
-    if TEST:
-        from db_create import createDb
-        createDb(wiki_connection)
-        
-    wiki_artmgr = sqldb.SqlArticleManager(wiki_connection)
-    
-    wiki_manager = manager.WikiManager(wiki_artmgr)
-    userNsMgr = manager.UserNsManager(wiki_artmgr)
-    systemNsMgr = manager.SystemNsManager()
-    _systemList = SystemList(article.Subject('List', manager.SYSTEM_NS),
-                             wiki_manager)
-    systemNsMgr.register('List', _systemList)
-    wiki_manager.registerNsMgr(manager.DEFAULT_NS, userNsMgr)
-    wiki_manager.registerNsMgr(manager.CATEGORY_NS, userNsMgr)
-    wiki_manager.registerNsMgr(manager.TEMPLATE_NS, userNsMgr)
-    wiki_manager.registerNsMgr(manager.SYSTEM_NS, systemNsMgr)
-    
-    wiki_formatter = formatter.HtmlBuilder()
-    wiki_parser = wikiparser.WikiParser(wiki_formatter, wiki_manager)
-    
-    page_factory = wikipage.WikiPageFactory(WIKI_NAME, __copyright__,
-                                            wiki_parser, wiki_formatter,
-                                            wiki_manager, options.tmpl)
+    nb_threads = int(options.threads)
+    if options.async_io and nb_threads == 0:
+        nb_threads = 4
+    nb_workers = int(options.workers)
 
     server_address = ('', int(options.port))
-    httpd = BaseHTTPServer.HTTPServer(server_address, PwikiHTTPRequestHandler)
-    sa = httpd.socket.getsockname()
-    print "Serving", PwikiHTTPRequestHandler.server_version, "on", \
-          sa[0], "port", sa[1], "..."
-    httpd.serve_forever()
+    if nb_workers > 0:
+        if not hasattr(os, 'fork'):
+            parser.error("--workers is not supported on this platform")
+        if options.async_io:
+            parser.error("--workers can't be used with --async")
+        prepareDb(options)
+        # the workers share the listening socket of the supervisor
+        listener = BaseHTTPServer.HTTPServer(server_address,
+                                             PwikiHTTPRequestHandler)
+        def serveWorker():
+            setupWiki(options, nb_threads, True)
+            httpd = createServer(server_address, nb_threads, False,
+                                 listener.socket)
+            httpserver.serveUntilStopped(httpd)
+        supervisor = httpserver.PreforkSupervisor(nb_workers, serveWorker)
+        sa = listener.socket.getsockname()
+        print "Serving", PwikiHTTPRequestHandler.server_version, "on", \
+              sa[0], "port", sa[1], "with", nb_workers, "workers..."
+        supervisor.run()
+    else:
+        setupWiki(options, nb_threads)
+        httpd = createServer(server_address, nb_threads, options.async_io)
+        sa = httpd.socket.getsockname()
+        print "Serving", PwikiHTTPRequestHandler.server_version, "on", \
+              sa[0], "port", sa[1], "..."
+        httpd.serve_forever()
 
 # End
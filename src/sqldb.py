@@ -3,7 +3,91 @@
 
 import article
 import re
-from manager import CATEGORY_NS
+import threading
+import sqlite3
+import time
+import random
+from manager import CATEGORY_NS, TEMPLATE_NS
+from wikiparser import extractLinks
+from wikiexc import WikiException
+
+# maximum number of host parameters in a query (a power of two)
+_MAX_QUERY_PARAMS = 512
+
+# INSERT ... ON CONFLICT DO UPDATE is supported since SQLite 3.24
+_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# time (in milliseconds) a connection waits for a lock held by another one
+DEFAULT_BUSY_TIMEOUT = 5000
+
+# number of attempts of a write transaction failing on a busy database
+_BUSY_ATTEMPTS = 5
+
+# delay (in seconds) before the first new attempt, doubled at each attempt
+_BUSY_BACKOFF = 0.05
+
+# articles depending on a subject (pl_ns, pl_title): linking to it or
+# including it, directly or through the templates they include
+_DEPENDENT_CTE = """
+WITH RECURSIVE dependent(art_id, art_title, art_ns) AS (
+    SELECT art_id, art_title, art_ns
+    FROM pagelinks, article
+    WHERE pl_ns = ?
+      AND pl_title = ?
+      AND art_id = pl_from
+  UNION
+    SELECT article.art_id, article.art_title, article.art_ns
+    FROM dependent, pagelinks, article
+    WHERE dependent.art_ns = ?
+      AND pl_ns = dependent.art_ns
+      AND pl_title = dependent.art_title
+      AND article.art_id = pl_from
+)
+"""
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+TEMP_STORES = ('default', 'file', 'memory')
+
+def connect(db_name, journal_mode=None, synchronous=None, cache_size=None,
+            mmap_size=None, temp_store=None, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+    """Open a connection to a wiki database.
+
+    The write transactions are immediate: they take the write lock as soon
+    as they start. The tuning parameters left to None keep the SQLite
+    defaults.
+
+    @param journal_mode: one of JOURNAL_MODES; in 'wal' mode, the readers
+    don't wait for the writers (the mode is stored in the database).
+    @param synchronous: one of SYNCHRONOUS_MODES.
+    @param cache_size: page cache size of the connection in KiB.
+    @param mmap_size: maximum size of the memory-mapped part of the database
+    in bytes.
+    @param temp_store: one of TEMP_STORES.
+    @param busy_timeout: time in milliseconds a statement waits for a lock
+    held by another connection before failing.
+    """
+    connection = sqlite3.connect(db_name, timeout=busy_timeout / 1000.0,
+                                 isolation_level="IMMEDIATE")
+    if journal_mode is not None and db_name != ':memory:':
+        connection.execute("PRAGMA journal_mode = %s" % journal_mode).fetchone()
+    if synchronous is not None:
+        connection.execute("PRAGMA synchronous = %s" % synchronous)
+    if cache_size is not None:
+        # a negative size is a number of KiB
+        connection.execute("PRAGMA cache_size = %d" % -int(cache_size))
+    if mmap_size is not None:
+        connection.execute("PRAGMA mmap_size = %d" % int(mmap_size)).fetchone()
+    if temp_store is not None:
+        connection.execute("PRAGMA temp_store = %s" % temp_store)
+    return connection
+
+def isBusyError(error):
+    """Check if a database error means another connection holds the lock.
+    """
+    message = str(error)
+    return isinstance(error, sqlite3.OperationalError) \
+           and ('locked' in message or 'busy' in message)
 
 def _regexp(pattern, st):
     return re.match(pattern, st) is not None
@@ -12,6 +96,51 @@ def matchRedirect(wiki_article):
     return re.match(r'%%REDIRECT:\s*(?P<link>[^\]]*)',
                     wiki_article.getContent().strip())
 
+class ThreadLocalConnection(object):
+    """Database connection giving each thread its own SQLite connection.
+    
+    The connections are opened on demand by the connect function. The
+    functions created with create_function() are registered on every
+    connection.
+    """
+    def __init__(self, connect):
+        self.__connect = connect
+        self.__local = threading.local()
+        self.__functions = []
+
+    def __getConnection(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = self.__connect()
+            for args in self.__functions:
+                connection.create_function(*args)
+            self.__local.connection = connection
+        return connection
+
+    def create_function(self, name, nb_args, func):
+        self.__functions.append((name, nb_args, func))
+        self.__getConnection().create_function(name, nb_args, func)
+
+    def cursor(self):
+        return self.__getConnection().cursor()
+
+    def execute(self, *args):
+        return self.__getConnection().execute(*args)
+
+    def commit(self):
+        self.__getConnection().commit()
+
+    def rollback(self):
+        self.__getConnection().rollback()
+
+    def close(self):
+        """Close the connection of the current thread.
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is not None:
+            self.__local.connection = None
+            connection.close()
+
 class SqlArticleStats(article.ArticleStats):
     def __init__(self, row):
         # row :=: (0:title, 1:ns, 2:ctime, 3:mtime,
@@ -44,9 +173,111 @@ class SqlArticleStats(article.ArticleStats):
         return self.__row[6]
 
 class SqlArticleManager(article.ArticleManager):
-    def __init__(self, connection):
+    """Article manager based on a SQLite database.
+    
+    @param index: optional in-memory index of the existing subjects (see
+    L{subjindex}), loaded at creation and kept up to date on set and delete.
+    Existence checks are answered by the index, so that they only hit the
+    database when the index is not exact.
+
+    The generation of the articles is kept in the database (it is
+    incremented by triggers on the article table) and read again after each
+    change, so that it is the same in all the processes.
+
+    The transaction creating or deleting a subject, or modifying a
+    template, also drops the stored rendered content of the articles
+    linking to it (see L{cache.RenderStore}), whoever listens to the
+    changes.
+
+    The database must be at the current schema version (see L{dbschema}).
+    """
+    def __init__(self, connection, index=None):
         self.__connection = connection
+        self.__index = index
+        # last data version seen by the connection of each thread
+        self.__local = threading.local()
+        # last generation read from the database
+        self.__generation = None
+        self.__generationLock = threading.Lock()
         self.__connection.create_function("regexp", 2, _regexp)
+        if self.__index is not None:
+            self.loadIndex()
+
+    def __getDataVersion(self):
+        cursor = self.__connection.cursor()
+        cursor.execute("PRAGMA data_version")
+        version = cursor.fetchone()[0]
+        cursor.close()
+        return version
+
+    def refresh(self):
+        # the data version of a connection changes each time another
+        # connection commits a change, to the articles or not (the rendered
+        # content...)
+        version = self.__getDataVersion()
+        if version == getattr(self.__local, 'data_version', None):
+            return False
+        self.__local.data_version = version
+        # only the changes to the articles increment the generation, and
+        # the changes made by this manager are already taken into account
+        generation = self.__readGeneration()
+        with self.__generationLock:
+            known = self.__generation
+            if known is None or generation > known:
+                self.__generation = generation
+        if known is None or generation <= known:
+            return False
+        if self.__index is not None:
+            self.loadIndex()
+        return True
+
+    def __readGeneration(self):
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT gen_value
+FROM generation
+""")
+        generation = int(cursor.fetchone()[0])
+        cursor.close()
+        return generation
+
+    def __setGeneration(self, generation):
+        # the generations read by concurrent threads may come out of order
+        with self.__generationLock:
+            if self.__generation is None or generation > self.__generation:
+                self.__generation = generation
+
+    def getGeneration(self):
+        if self.__generation is None:
+            self.__setGeneration(self.__readGeneration())
+        return self.__generation
+
+    def __write(self, method, *args):
+        """Run a write transaction, again after a while if the database is
+        busy.
+        """
+        delay = _BUSY_BACKOFF
+        for attempt in range(_BUSY_ATTEMPTS):
+            try:
+                return method(*args)
+            except sqlite3.OperationalError, e:
+                self.__connection.rollback()
+                if not isBusyError(e) or attempt == _BUSY_ATTEMPTS - 1:
+                    raise
+            # spread the new attempts of the competing writers
+            time.sleep(delay * (1 + random.random()))
+            delay *= 2
+
+    def loadIndex(self):
+        """(Re)load the index of the existing subjects from the database.
+        """
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT art_title, art_ns
+FROM article
+""")
+        self.__index.reset([article.Subject(title, ns) for title, ns in cursor])
+        cursor.close()
 
     def __getArticleId(self, subject):
         cursor = self.__connection.cursor()
@@ -60,20 +291,12 @@ WHERE art_title = ?
         cursor.close()
         return int(art_id)
 
-    def __isRedirect(self, subject):
-        cursor = self.__connection.cursor()
-        cursor.execute("""
-SELECT COUNT(*)
-FROM article, redirect
-WHERE article.art_title = ?
-  AND article.art_ns = ?
-  AND article.art_id = redirect.art_id
-""", (subject.getTitle(), subject.getNamespace()))
-        result = int(cursor.fetchone()[0]) != 0
-        cursor.close()
-        return result
-
     def contains(self, subject):
+        if self.__index is not None:
+            if not self.__index.mightContain(subject):
+                return False
+            if self.__index.isExact():
+                return True
         cursor = self.__connection.cursor()
         cursor.execute("""
 SELECT COUNT(*)
@@ -85,57 +308,92 @@ WHERE art_title = ?
         cursor.close()
         return result
 
-    def get(self, subject):
-        art_id = self.__getArticleId(subject)
-        is_redirect = self.__isRedirect(subject)
+    def filterExisting(self, subjects):
+        if self.__index is not None:
+            subjects = [subject for subject in subjects
+                        if self.__index.mightContain(subject)]
+            if self.__index.isExact():
+                return set(subjects)
+        titles_by_ns = {}
+        for subject in subjects:
+            titles_by_ns.setdefault(subject.getNamespace(), set()).add(subject.getTitle())
+        existing = set()
         cursor = self.__connection.cursor()
-        if is_redirect:
-            # the article is a redirection
-            cursor.execute("""\
-SELECT rd_title, rd_ns
-FROM redirect
-WHERE art_id = %d
-""" % art_id)
-            title, ns = cursor.fetchone()
-            rd_subject = article.Subject(title, ns)
-            art = article.RedirectArticle(subject, rd_subject)
-        else:
-            # get the article content
-            cursor.execute("""\
-SELECT cont_text
-FROM content
-WHERE art_id = %d
-""" % art_id)
-            content = cursor.fetchone()[0]
-            # get all the categories the article owned to
-            cursor.execute("""\
-SELECT cat_art_title
-FROM category
-WHERE art_id = %d
-""" % art_id)
-            categories = tuple(row[0] for row in cursor)
-
-            if subject.getNamespace() == CATEGORY_NS:
-                # the article is a category article
-                # ...get all subjects of a category
+        for ns, titles in titles_by_ns.items():
+            titles = list(titles)
+            for i in range(0, len(titles), _MAX_QUERY_PARAMS):
+                chunk = titles[i:i + _MAX_QUERY_PARAMS]
+                # pad the list to a power of two, so that only a few
+                # statements are prepared (and reused)
+                size = 8
+                while size < len(chunk):
+                    size *= 2
+                chunk += [chunk[-1]] * (size - len(chunk))
                 cursor.execute("""
-SELECT art_title, art_ns
+SELECT art_title
+FROM article
+WHERE art_ns = ?
+  AND art_title IN (%s)
+""" % ', '.join('?' * len(chunk)), [ns] + chunk)
+                for row in cursor:
+                    existing.add(article.Subject(row[0], ns))
+        cursor.close()
+        return existing
+
+    def get(self, subject):
+        # everything is read by a single statement, so that the article is
+        # read from a single snapshot of the database:
+        #   0 | art_id | art_mtime | rd_title       | rd_ns     | cont_text
+        #   1 |        | rank      | category title |           |
+        #   2 |        |           | member title   | member ns |
+        # (the members are only read for category articles, the categories
+        # are ranked in the order they have been declared)
+        title, ns = subject.getTitle(), subject.getNamespace()
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT 0, article.art_id, art_mtime, rd_title, rd_ns, cont_text
+FROM
+  article
+    LEFT JOIN redirect ON article.art_id = redirect.art_id
+    LEFT JOIN content  ON article.art_id = content.art_id
+WHERE art_title = ?
+  AND art_ns = ?
+UNION ALL
+SELECT 1, NULL, category.rowid, cat_art_title, NULL, NULL
 FROM article, category
-WHERE cat_art_title = ?
+WHERE art_title = ?
+  AND art_ns = ?
   AND category.art_id = article.art_id
-ORDER BY art_ns, art_title ASC
-""", (subject.getTitle(),))
-                subjects = {}
-                for row in cursor:
-                    title, ns = row
-                    subjects.setdefault(ns, []).append(article.Subject(title, ns))
-                art = article.CategoryArticle(subject, content, subjects, categories)
-            else:
-                # it is a normal article
-                art = article.UserArticle(subject, content, categories)
-        
+UNION ALL
+SELECT 2, NULL, NULL, art_title, art_ns, NULL
+FROM article, category
+WHERE ?
+  AND cat_art_title = ?
+  AND category.art_id = article.art_id
+ORDER BY 1, 3, 5, 4
+""", (title, ns, title, ns, ns == CATEGORY_NS, title))
+        rows = cursor.fetchall()
         cursor.close()
-        return art
+        if len(rows) == 0 or rows[0][0] != 0:
+            raise WikiException, 'Subject unknown: ' + unicode(subject)
+        kind, art_id, mtime, rd_title, rd_ns, content = rows[0]
+        if rd_title is not None:
+            # the article is a redirection
+            rd_subject = article.Subject(rd_title, rd_ns)
+            return article.RedirectArticle(subject, rd_subject, mtime)
+        # all the categories the article belongs to
+        categories = tuple(row[3] for row in rows if row[0] == 1)
+        if ns == CATEGORY_NS:
+            # the article is a category article
+            # ...with all the subjects of the category
+            subjects = {}
+            for row in rows:
+                if row[0] == 2:
+                    subjects.setdefault(row[4], []).append(article.Subject(row[3], row[4]))
+            return article.CategoryArticle(subject, content, subjects,
+                                           categories, mtime)
+        # it is a normal article
+        return article.UserArticle(subject, content, categories, mtime)
 
     def subjects(self):
         cursor = self.__connection.cursor()
@@ -171,103 +429,132 @@ FROM article
         cursor.close()
         return result
 
-    def __setUserArticle(self, art):
-        subject = art.getSubject()
-        content = art.getContent()
-        categories = art.getCategories()
-        cursor = self.__connection.cursor()
+    def __setArticle(self, subject, content, rd_subject, categories, links):
+        """Write an article in a single transaction.
 
-        if self.contains(art.getSubject()):
-            # the article exists in the database
-            art_id = self.__getArticleId(subject)
-            if self.__isRedirect(subject):
-                # if the article was a redirection
-                # delete it from the redirect table
-                cursor.execute("""
-DELETE FROM redirect
-WHERE art_id = %d
-""" % art_id)
-            # delete all references in the category table
-            # in a view to replace them later...
-            cursor.execute("""
-DELETE FROM category
-WHERE art_id = %d
-""" % art_id)
-            # update the modification time
+        @param content: content of a user article, or None.
+        @param rd_subject: subject of a redirection, or None.
+        @param links: subjects the article links to (see L{getLinksTo}).
+        """
+        cursor = self.__connection.cursor()
+        title, ns = subject.getTitle(), subject.getNamespace()
+        cursor.execute("""
+SELECT COUNT(*)
+FROM article
+WHERE art_title = ?
+  AND art_ns = ?
+""", (title, ns))
+        created = int(cursor.fetchone()[0]) == 0
+        # create the article or update its modification time
+        if _HAS_UPSERT:
             cursor.execute("""
-UPDATE article
-SET art_mtime = CURRENT_TIMESTAMP
-WHERE art_id = %d
-""" % art_id)
-            
+INSERT INTO article (art_title, art_ns, art_ctime, art_mtime)
+    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+ON CONFLICT (art_ns, art_title) DO UPDATE
+    SET art_mtime = CURRENT_TIMESTAMP
+""", (title, ns))
         else:
-            # the article is unknown in the database
-            # ... add it
             cursor.execute("""
-INSERT INTO article (art_title, art_ns, art_ctime, art_mtime)
+INSERT OR IGNORE INTO article (art_title, art_ns, art_ctime, art_mtime)
     VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-""", (subject.getTitle(), subject.getNamespace()))
+""", (title, ns))
+            if cursor.rowcount == 0:
+                cursor.execute("""
+UPDATE article
+SET art_mtime = CURRENT_TIMESTAMP
+WHERE art_title = ?
+  AND art_ns = ?
+""", (title, ns))
+        cursor.execute("""
+SELECT art_id
+FROM article
+WHERE art_title = ?
+  AND art_ns = ?
+""", (title, ns))
+        art_id = cursor.fetchone()[0]
 
-        # update the article content
-        art_id = self.__getArticleId(subject)
-        cursor.execute(r"""
+        if rd_subject is None:
+            cursor.execute("""
 INSERT OR REPLACE INTO content
-    VALUES (%d, ?, %d)
-""" % (art_id, len(content)), (content,))
+    VALUES (?, ?, ?)
+""", (art_id, content, len(content)))
+            # the article may have been a redirection
+            cursor.execute("""
+DELETE FROM redirect
+WHERE art_id = ?
+""", (art_id,))
+        else:
+            cursor.execute("""
+INSERT OR REPLACE INTO redirect
+    VALUES (?, ?, ?)
+""", (art_id, rd_subject.getTitle(), rd_subject.getNamespace()))
+            # the article may have been a user article
+            cursor.execute("""
+DELETE FROM content
+WHERE art_id = ?
+""", (art_id,))
 
-        # update the category links
-        params = []
+        # only update the category links which have changed
+        cursor.execute("""
+SELECT cat_art_title
+FROM category
+WHERE art_id = ?
+""", (art_id,))
+        old_categories = set(row[0] for row in cursor)
+        new_categories = set(categories)
+        cursor.executemany("""
+DELETE FROM category
+WHERE cat_art_title = ?
+  AND art_id = ?
+""", [(category, art_id)
+      for category in old_categories - new_categories])
+        # keep the declaration order of the new categories
+        added = []
         for category in categories:
-            params.append((category, art_id))
-        cursor.executemany(r"""
+            if category not in old_categories and category not in added:
+                added.append(category)
+        cursor.executemany("""
 INSERT INTO category
     VALUES (?, ?)
-""", params)
-        cursor.close()
-        self.__connection.commit()
+""", [(category, art_id) for category in added])
 
-    def __setRedirectArticle(self, art):
-        subject = art.getSubject()
-        rd_subject = art.redirectTo()
-        cursor = self.__connection.cursor()
-        
-        if self.contains(subject):
-            # the article exists in the database
-            art_id = self.__getArticleId(subject)
-            if not self.__isRedirect(subject):
-                # the article was not a redirection
-                # ... delete its content
-                cursor.execute("""
-DELETE FROM content
-WHERE art_id = %d
-""" % art_id)
-                # ... and all category links
-                cursor.execute("""
-DELETE FROM category
-WHERE art_id = %d
-""" % art_id)
-            # update the modification time
-            cursor.execute("""
-UPDATE article
-SET art_mtime = CURRENT_TIMESTAMP
-WHERE art_id = %d
-""" % art_id)
-        else:
-            # the article is unknown in the database
-            # ... create it
-            cursor.execute("""
-INSERT INTO article (art_title, art_ns, art_ctime, art_mtime)
-    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-""", (subject.getTitle(), subject.getNamespace()))
+        # same for the links
+        cursor.execute("""
+SELECT pl_ns, pl_title
+FROM pagelinks
+WHERE pl_from = ?
+""", (art_id,))
+        old_links = set(cursor.fetchall())
+        new_links = set((link.getNamespace(), link.getTitle()) for link in links)
+        cursor.executemany("""
+DELETE FROM pagelinks
+WHERE pl_from = ?
+  AND pl_ns = ?
+  AND pl_title = ?
+""", [(art_id, ns, title) for ns, title in old_links - new_links])
+        cursor.executemany("""
+INSERT INTO pagelinks
+    VALUES (?, ?, ?)
+""", [(art_id, ns, title) for ns, title in new_links - old_links])
 
-        # set the redirection
-        art_id = self.__getArticleId(subject)
-        cursor.execute(r"""
-INSERT OR REPLACE INTO redirect
-    VALUES (%d, ?, ?)
-""" % art_id, (rd_subject.getTitle(), rd_subject.getNamespace()))
+        # the links to a new subject change class, and the articles
+        # including a template change
+        if created or subject.getNamespace() == TEMPLATE_NS:
+            self.__deleteRenderedLinksTo(cursor, subject)
+        generation = self.__readGeneration()
         cursor.close()
         self.__connection.commit()
+        self.__setGeneration(generation)
+        if self.__index is not None:
+            self.__index.add(subject)
+
+    def __setUserArticle(self, art):
+        self.__setArticle(art.getSubject(), art.getContent(), None,
+                          art.getCategories(), extractLinks(art.getContent()))
+
+    def __setRedirectArticle(self, art):
+        self.__setArticle(art.getSubject(), None, art.redirectTo(), (),
+                          (art.redirectTo(),))
 
     def __setCategoryArticle(self, art):
         # a category article is like a user article
@@ -276,33 +563,173 @@ INSERT OR REPLACE INTO redirect
     def set(self, art):
         art_cls_name = art.__class__.__name__
         method_name = '_' + self.__class__.__name__ + '__set' + art_cls_name
-        self.__getattribute__(method_name)(art)
+        self.__write(self.__getattribute__(method_name), art)
 
-    def delete(self, subject):
+    def getLinksTo(self, subject):
+        """Get the statistics of the articles linking to a subject.
+
+        The links of an article are extracted from its source when it is
+        written (see L{wikiparser.extractLinks}): its internal links, its
+        categories, the templates it includes, or the target of a
+        redirection.
+
+        @rtype: list of L{SqlArticleStats}
+        """
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT art_title, art_ns, art_ctime, art_mtime, rd_title, rd_ns, cont_len
+FROM
+  pagelinks
+    JOIN article      ON pl_from = article.art_id
+    LEFT JOIN redirect ON article.art_id = redirect.art_id
+    LEFT JOIN content  ON article.art_id = content.art_id
+WHERE pl_ns = ?
+  AND pl_title = ?
+ORDER BY art_ns, art_title ASC
+""", (subject.getNamespace(), subject.getTitle()))
+        stats = [SqlArticleStats(row) for row in cursor]
+        cursor.close()
+        return stats
+
+    def getDependents(self, subject):
+        """Get the subjects of the articles whose rendered content depends
+        on a subject: the articles linking to it or including it, directly
+        or through the templates they include.
+
+        These are the articles to render again when the subject is created
+        or deleted (their links change class), or, for a template, modified.
+        The links built from template parameters are not known (see
+        L{wikiparser.extractLinks}).
+
+        @rtype: set of L{article.Subject}
+        """
+        cursor = self.__connection.cursor()
+        cursor.execute(_DEPENDENT_CTE + """
+SELECT art_title, art_ns
+FROM dependent
+""", (subject.getNamespace(), subject.getTitle(), TEMPLATE_NS))
+        subjects = set(article.Subject(title, ns) for title, ns in cursor)
+        cursor.close()
+        return subjects
+
+    def getWantedSubjects(self, limit=None):
+        """Get the subjects which don't exist but are linked to, the most
+        linked first.
+
+        @param limit: maximum number of subjects, None for all.
+        @return: list of (subject, number of articles linking to it).
+        """
+        if limit is None:
+            limit = -1
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT pl_title, pl_ns, COUNT(*)
+FROM
+  pagelinks
+    LEFT JOIN article ON art_ns = pl_ns AND art_title = pl_title
+WHERE art_id IS NULL
+GROUP BY pl_ns, pl_title
+ORDER BY COUNT(*) DESC, pl_ns, pl_title
+LIMIT ?
+""", (limit,))
+        wanted = [(article.Subject(title, ns), int(count))
+                  for title, ns, count in cursor]
+        cursor.close()
+        return wanted
+
+    def getRendered(self, subject, version):
+        """Get the rendered content stored for an article.
+        
+        @return: the tuple (content, mtime of the rendered article) or None
+        if no content has been rendered by this version of the parser.
+        """
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT rend_text, rend_mtime
+FROM article, render
+WHERE art_title = ?
+  AND art_ns = ?
+  AND article.art_id = render.art_id
+  AND rend_version = ?
+""", (subject.getTitle(), subject.getNamespace(), version))
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+
+    def getRenderedLinks(self, subject):
+        """Get the subjects the stored rendered content of an article links to.
+        """
+        cursor = self.__connection.cursor()
+        cursor.execute("""
+SELECT rl_title, rl_ns
+FROM article, render_link
+WHERE art_title = ?
+  AND art_ns = ?
+  AND article.art_id = render_link.art_id
+""", (subject.getTitle(), subject.getNamespace()))
+        links = [article.Subject(title, ns) for title, ns in cursor]
+        cursor.close()
+        return links
+
+    def setRendered(self, subject, version, mtime, content, links):
+        """Store the rendered content of an article and the subjects it
+        links to.
+        """
+        self.__write(self.__setRendered, subject, version, mtime, content,
+                     links)
+
+    def __setRendered(self, subject, version, mtime, content, links):
         art_id = self.__getArticleId(subject)
         cursor = self.__connection.cursor()
-        # delete the article metadata
         cursor.execute("""
-DELETE FROM article
-WHERE art_id = %d
-""" % art_id)
-        # delete its content
+INSERT OR REPLACE INTO render
+    VALUES (?, ?, ?, ?)
+""", (art_id, version, mtime, content))
         cursor.execute("""
-DELETE FROM content
-WHERE art_id = %d
-""" % art_id)
-        # delete its redirection
+DELETE FROM render_link
+WHERE art_id = ?
+""", (art_id,))
+        params = []
+        for link in set(links):
+            params.append((art_id, link.getTitle(), link.getNamespace()))
+        cursor.executemany("""
+INSERT INTO render_link
+    VALUES (?, ?, ?)
+""", params)
+        cursor.close()
+        self.__connection.commit()
+
+    def __deleteRenderedLinksTo(self, cursor, subject):
+        """Delete the stored rendered content of all articles linking to a
+        subject, in the transaction writing the subject.
+        """
         cursor.execute("""
-DELETE FROM redirect
-WHERE art_id = %d
-""" % art_id)
-        # delete all category links to it
+DELETE FROM render
+WHERE art_id IN (SELECT art_id
+                 FROM render_link
+                 WHERE rl_title = ?
+                   AND rl_ns = ?)
+""", (subject.getTitle(), subject.getNamespace()))
+
+    def delete(self, subject):
+        self.__write(self.__delete, subject)
+
+    def __delete(self, subject):
+        # the content, redirection, category links, links and rendered
+        # content of the article are deleted by the article_delete trigger
+        cursor = self.__connection.cursor()
         cursor.execute("""
-DELETE FROM category
-WHERE art_id = %d
-""" % art_id)
+DELETE FROM article
+WHERE art_title = ?
+  AND art_ns = ?
+""", (subject.getTitle(), subject.getNamespace()))
+        self.__deleteRenderedLinksTo(cursor, subject)
+        generation = self.__readGeneration()
         cursor.close()
         self.__connection.commit()
+        self.__setGeneration(generation)
+        if self.__index is not None:
+            self.__index.remove(subject)
 
 def dumpCursor(cursor):
     fields = tuple(unicode(field[0]) for field in cursor.description)
@@ -0,0 +1,92 @@
+# static.py -
+#
+
+import os
+import email.utils
+
+# files bigger than this size (in bytes) are not kept in memory
+DEFAULT_MEMORY_LIMIT = 256 * 1024
+
+def httpDate(timestamp):
+    """Format a timestamp as an HTTP date.
+    """
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def parseHttpDate(st):
+    """Parse an HTTP date into a timestamp, or None if the date is invalid.
+    """
+    date = email.utils.parsedate_tz(st)
+    if date is None:
+        return None
+    return email.utils.mktime_tz(date)
+
+class StaticFile(object):
+    """A file served as is, as it was when it was loaded.
+
+    The content of small files is kept in memory; the other ones are read
+    from their path when they are sent.
+    """
+    def __init__(self, path, content_type, mtime, size, content=None):
+        self.__path = path
+        self.__contentType = content_type
+        self.__mtime = mtime
+        self.__size = size
+        self.__content = content
+
+    def getPath(self):
+        return self.__path
+
+    def getContentType(self):
+        return self.__contentType
+
+    def getContent(self):
+        """Get the content of the file, or None if it is not kept in memory.
+        """
+        return self.__content
+
+    def getModificationTime(self):
+        return self.__mtime
+
+    def getSize(self):
+        return self.__size
+
+    def getETag(self):
+        return '"%x-%x"' % (self.__mtime, self.__size)
+
+class StaticFileCache(object):
+    """Keep the static files served by the wiki.
+
+    The files are checked for changes (modification time and size) each time
+    they are requested, and loaded again if needed.
+    """
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT):
+        self.__memoryLimit = memory_limit
+        self.__files = {}
+
+    def get(self, path, content_type):
+        """Get an up-to-date static file, or None if it doesn't exist.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.__files.pop(path, None)
+            return None
+        mtime, size = int(st.st_mtime), st.st_size
+        static_file = self.__files.get(path)
+        if static_file is None or static_file.getModificationTime() != mtime \
+           or static_file.getSize() != size:
+            content = None
+            if size <= self.__memoryLimit:
+                try:
+                    f = open(path, 'rb')
+                except IOError:
+                    return None
+                try:
+                    content = f.read()
+                finally:
+                    f.close()
+            static_file = StaticFile(path, content_type, mtime, size, content)
+            self.__files[path] = static_file
+        return static_file
+
+# End
@@ -0,0 +1,96 @@
+# subjindex.py -
+#
+
+import hashlib
+import math
+import struct
+import threading
+
+def _key(subject):
+    return subject.getNamespace() + u'\0' + subject.getTitle()
+
+class SubjectIndex(object):
+    """In-memory index of the existing subjects.
+
+    The index is exact: a subject is in the index if and only if the
+    article exists.
+    """
+    def __init__(self):
+        self.__keys = set()
+
+    def isExact(self):
+        """Check if the positive answers of mightContain() are certain.
+        """
+        return True
+
+    def reset(self, subjects):
+        """Replace the content of the index.
+
+        @param subjects: all the existing subjects.
+        @type subjects: list
+        """
+        self.__keys = set(_key(subject) for subject in subjects)
+
+    def add(self, subject):
+        self.__keys.add(_key(subject))
+
+    def remove(self, subject):
+        self.__keys.discard(_key(subject))
+
+    def mightContain(self, subject):
+        return _key(subject) in self.__keys
+
+    def __len__(self):
+        return len(self.__keys)
+
+class BloomSubjectIndex(object):
+    """Bloom filter of the existing subjects, for very large wikis.
+
+    The filter only uses a few bits per subject, but it is not exact: a
+    negative answer is certain, whereas a positive one must be confirmed.
+    Removed subjects stay in the filter until the next reset.
+
+    @param error_rate: expected false positive rate.
+    """
+    def __init__(self, error_rate=0.01):
+        self.__errorRate = error_rate
+        self.__bits = bytearray(1)
+        self.__nbBits = 8
+        self.__nbHashes = 1
+        # setting bits isn't atomic
+        self.__lock = threading.Lock()
+
+    def isExact(self):
+        return False
+
+    def __positions(self, subject):
+        digest = hashlib.md5(_key(subject).encode('utf8')).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        for i in range(self.__nbHashes):
+            yield (h1 + i * h2) % self.__nbBits
+
+    def reset(self, subjects):
+        # leave room for the subjects created later
+        capacity = max(2 * len(subjects), 1024)
+        nb_bits = int(-capacity * math.log(self.__errorRate) / (math.log(2) ** 2))
+        self.__nbBits = (nb_bits // 8 + 1) * 8
+        self.__nbHashes = max(1, int(round(math.log(2) * self.__nbBits / capacity)))
+        self.__bits = bytearray(self.__nbBits // 8)
+        for subject in subjects:
+            self.add(subject)
+
+    def add(self, subject):
+        with self.__lock:
+            for pos in self.__positions(subject):
+                self.__bits[pos >> 3] |= 1 << (pos & 7)
+
+    def remove(self, subject):
+        pass
+
+    def mightContain(self, subject):
+        for pos in self.__positions(subject):
+            if not self.__bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+# End
@@ -33,22 +33,42 @@ class WebPageHeader(WebPageObject):
 
 class WebPageContent(WebPageObject):
     def __init__(self, content):
+        """@param content: the HTML of the body, or an iterable generating
+        it piece by piece (iterated only once).
+        """
         self.__content = content
 
+    def iterHtml(self, encoding):
+        content = self.__content
+        if isinstance(content, basestring):
+            content = (content,)
+        yield '<body>\n'
+        for chunk in content:
+            yield chunk
+        yield '\n</body>'
+
     def getHtml(self, encoding):
-        out = '<body>'
-        out += '\n' + self.__content
-        return out + '\n</body>'
+        return u''.join(self.iterHtml(encoding))
 
 class WebPage(object):
     def __init__(self, header, content):
         self.__header = header
         self.__content = content
 
-    def getHtml(self, encoding):
+    def iterHtml(self, encoding):
+        """Iterate over the encoded HTML of the page.
+
+        A content given as an iterable is generated while iterating, so
+        that the start of the page can be sent before the rest is built.
+        """
         out = _xhtmlHeader(encoding) + '\n'
         out += self.__header.getHtml(encoding) + '\n'
-        out += self.__content.getHtml(encoding)
-        return (out + '\n</html>\n').encode(encoding)
+        yield out.encode(encoding)
+        for chunk in self.__content.iterHtml(encoding):
+            yield chunk.encode(encoding)
+        yield '\n</html>\n'.encode(encoding)
+
+    def getHtml(self, encoding):
+        return ''.join(self.iterHtml(encoding))
 
 # End
@@ -8,14 +8,69 @@ import manager
 
 import urllib
 import os
+import re
 
 _WIKI_MENU = article.Subject.fromString(u'%s:Menu' % manager.TEMPLATE_NS)
+# page of the articles linking to a subject (System:WhatLinksHere/Subject)
+_WHAT_LINKS_HERE = article.Subject(u'WhatLinksHere', manager.SYSTEM_NS)
 _DEFAULT_MENU_CONTENT = u"""\
 - [[|Home]]
 - [[System:List|Liste des articles]]
+- [[System:Wanted|Articles demandés]]
 """
 
-class WikiPageFactory(object):
+# fields of the page template: %(name)s, or %% for a percent sign
+_TEMPLATE_FIELD = re.compile(r'%(?:\((\w+)\)s|%)')
+
+# size (in characters) of the pieces of a streamed article content
+_CHUNK_SIZE = 16 * 1024
+
+def _parseTemplate(template):
+    """Split a page template into (text, name) parts, where name is the
+    name of the field following the text (None for the last part).
+    """
+    parts = []
+    text = []
+    pos = 0
+    for match in _TEMPLATE_FIELD.finditer(template):
+        text.append(template[pos:match.start()])
+        pos = match.end()
+        if match.group(1) is None:
+            text.append('%')
+        else:
+            parts.append((''.join(text), match.group(1)))
+            text = []
+    text.append(template[pos:])
+    parts.append((''.join(text), None))
+    return parts
+
+def _expandTemplate(parts, values):
+    """Generate a page from the parts of its template.
+
+    A value is either a string or an iterable generating the value piece
+    by piece: the text preceding it is generated first, so that it can be
+    sent before the iterable is consumed.
+    """
+    pending = []
+    for text, name in parts:
+        pending.append(text)
+        if name is None:
+            continue
+        value = values[name]
+        if isinstance(value, basestring):
+            pending.append(value)
+        else:
+            yield u''.join(pending)
+            pending = []
+            for chunk in value:
+                yield chunk
+    yield u''.join(pending)
+
+def _split(st, size=_CHUNK_SIZE):
+    for pos in xrange(0, len(st), size):
+        yield st[pos:pos + size]
+
+class WikiPageFactory(manager.ManagerListener):
     DEFAULT_TEMPLATE = """\
 <div id="wiki-header">
   <span id="wiki-product">%(wiki_name)s</span>
@@ -41,27 +96,169 @@ class WikiPageFactory(object):
 </div>
 """
     
-    def __init__(self, wiki_name, copyright, parser, formatter, manager, template):
+    def __init__(self, wiki_name, copyright, parser, formatter, manager, template,
+                 render_cache=None, render_store=None, stylesheet_url='/?getcss',
+                 editable=True):
         self.__wiki_name = wiki_name
         self.__copyright = copyright
         self.__parser = parser
         self.__formatter = formatter
         self.__manager = manager
         self.__template = template
+        self.__render_cache = render_cache
+        self.__render_store = render_store
+        self.__stylesheet_url = stylesheet_url
+        # the pages of a static site have no edit tab
+        self.__editable = editable
+        # rendered menu and the subjects it links to
+        self.__menu = None
+        # modification time of the menu article, as a string
+        self.__menuVersion = None
+        # page template and its modification time
+        self.__loadedTemplate = (self.DEFAULT_TEMPLATE, None)
+        # page template and its parts (see _parseTemplate)
+        self.__parsedTemplate = None
 
-    def buildMenu(self):
+    def __getTemplate(self):
+        """Get the page template, loaded again when its file changes.
+        
+        @return: the tuple (template, modification time of its file)
+        """
+        loaded = self.__loadedTemplate
+        if self.__template is None:
+            return loaded
+        try:
+            mtime = os.stat(self.__template).st_mtime
+        except OSError:
+            return (self.DEFAULT_TEMPLATE, None)
+        if mtime != loaded[1]:
+            f = file(self.__template, 'r')
+            try:
+                loaded = (f.read(), mtime)
+            finally:
+                f.close()
+            self.__loadedTemplate = loaded
+        return loaded
+
+    def __getTemplateParts(self):
+        template = self.__getTemplate()[0]
+        parsed = self.__parsedTemplate
+        if parsed is None or parsed[0] is not template:
+            parsed = (template, _parseTemplate(template))
+            self.__parsedTemplate = parsed
+        return parsed[1]
+
+    def getVersion(self):
+        """Get a string changing each time the page template or the menu
+        changes.
+
+        The modification time of the menu article is kept until the article
+        is modified or deleted.
+        """
+        menu_version = self.__menuVersion
+        if menu_version is None:
+            menu_mtime = None
+            if self.__manager.contains(_WIKI_MENU):
+                menu_mtime = self.__manager.get(_WIKI_MENU).getModificationTime()
+            menu_version = unicode(menu_mtime)
+            self.__menuVersion = menu_version
+        return u'%s/%s' % (self.__getTemplate()[1], menu_version)
+
+    def formatArticle(self, art):
+        """Render the content of an article.
+        
+        The content is first looked up in the render cache, then in the
+        render store, if any.
+        """
+        return u''.join(self.iterFormatArticle(art))
+
+    def iterFormatArticle(self, art):
+        """Render the content of an article piece by piece (see
+        L{formatArticle}).
+
+        An article which isn't stored is generated block by block while it
+        is rendered, then put in the render cache and store once complete.
+        """
+        if self.__render_cache is not None:
+            content = self.__render_cache.get(art)
+            if content is not None:
+                for chunk in _split(content):
+                    yield chunk
+                return
+        content = None
+        if self.__render_store is not None:
+            content = self.__render_store.lookup(art)
+        if content is None:
+            links = set()
+            if self.__render_cache is None and self.__render_store is None:
+                # nothing to keep
+                for chunk in self.__parser.iterRender(art, links):
+                    yield chunk
+                return
+            chunks = []
+            for chunk in self.__parser.iterRender(art, links):
+                chunks.append(chunk)
+                yield chunk
+            content = u''.join(chunks)
+            if self.__render_store is not None:
+                self.__render_store.put(art, content, links)
+        else:
+            for chunk in _split(content):
+                yield chunk
+            if self.__render_cache is not None:
+                links = self.__render_store.getLinks(art.getSubject())
+        if self.__render_cache is not None:
+            self.__render_cache.put(art, content, links)
+
+    def seedMenu(self):
+        """Create the default menu article if it doesn't exist yet.
+        """
         if not self.__manager.contains(_WIKI_MENU):
             wiki_article = article.UserArticle(_WIKI_MENU, _DEFAULT_MENU_CONTENT)
             self.__manager.set(wiki_article)
-        else:
-            wiki_article = self.__manager.get(_WIKI_MENU)
-            
-        content = self.__parser.format(wiki_article)
-        return """\
+
+    def buildMenu(self):
+        """Get the menu of the pages.
+        
+        The menu is rendered once, then kept until the menu article or a
+        subject it links to is created or deleted, or a template it includes
+        is modified.
+        """
+        menu = self.__menu
+        if menu is None:
+            if self.__manager.contains(_WIKI_MENU):
+                wiki_article = self.__manager.get(_WIKI_MENU)
+            else:
+                wiki_article = article.UserArticle(_WIKI_MENU, _DEFAULT_MENU_CONTENT)
+            content, links = self.__parser.render(wiki_article)
+            menu = ("""\
 <h1>Menu</h1>
 <div>
 %s
-</div>""" % content
+</div>""" % content, links)
+            self.__menu = menu
+        return menu[0]
+
+    def articleSet(self, subject, created):
+        if subject == _WIKI_MENU:
+            self.__menuVersion = None
+        menu = self.__menu
+        if menu is not None \
+           and (subject == _WIKI_MENU
+                or ((created or subject.getNamespace() == manager.TEMPLATE_NS)
+                    and subject in menu[1])):
+            self.__menu = None
+
+    def articleDeleted(self, subject):
+        if subject == _WIKI_MENU:
+            self.__menuVersion = None
+        menu = self.__menu
+        if menu is not None and (subject == _WIKI_MENU or subject in menu[1]):
+            self.__menu = None
+
+    def articlesReset(self):
+        self.__menu = None
+        self.__menuVersion = None
 
     def buildTabs(self, tabs):
         tabs_html = '<div id="wiki-tabs">'
@@ -70,31 +267,32 @@ class WikiPageFactory(object):
         return tabs_html + '</div>\n'
 
     def _buildPage(self, title, tabs, content):
+        """Build a page of the wiki.
+
+        @param content: the HTML of the page content, or an iterable
+        generating it only when the page is generated (see
+        L{webpage.WebPage.iterHtml}).
+        """
         title = unicode(title)
         subject = title
         if subject == '':
             title = '(Home)'
         web_header = webpage.WebPageHeader(self.__wiki_name + ' >>> ' + title)
-        web_header.append('<link rel="stylesheet" type="text/css" href="/?getcss" />')
+        web_header.append('<link rel="stylesheet" type="text/css" href="%s" />'
+                          % self.__stylesheet_url)
         
         tabs_content = self.buildTabs(tabs)
         menu_content = self.buildMenu()
 
-        template = self.DEFAULT_TEMPLATE
-        if self.__template is not None:
-            if os.path.isfile(self.__template):
-                f = file(self.__template, 'r')
-                try:
-                    template = f.read()
-                finally:
-                    f.close()
+        template_parts = self.__getTemplateParts()
             
-        html_content = template % {'wiki_name': self.__wiki_name,
-                                   'title': title,
-                                   'tabs': tabs_content,
-                                   'content': content,
-                                   'copy': self.__copyright,
-                                   'menu': menu_content}
+        html_content = _expandTemplate(template_parts,
+                                       {'wiki_name': self.__wiki_name,
+                                        'title': title,
+                                        'tabs': tabs_content,
+                                        'content': content,
+                                        'copy': self.__copyright,
+                                        'menu': menu_content})
         
         web_content = webpage.WebPageContent(html_content)
         return webpage.WebPage(web_header, web_content)
@@ -130,37 +328,51 @@ class WikiPageFactory(object):
         return content
 
     def buildConsultPage(self, art):
+        """Build the consultation page of an article.
+
+        The article is rendered while the page is generated, after the
+        header and the menu.
+        """
         subject = art.getSubject()
-        article_content = u''
         
         if subject.getNamespace() == manager.SYSTEM_NS:
             tabs = [
                 ('home', '/', 'go to the main page'),
                 ('list', '/System:List', 'list of articles'),
                 ]
-            article_content = art.getContent()
         else:
             tabs = [
-                ('edit', '/%s?action=edit' % subject, 'edit %s' % subject),
                 ('home', '/', 'go to the main page'),
                 ('list', '/System:List', 'list of articles'),
                 ]
-            article_content = self.__parser.format(art)
+            if self.__manager.contains(_WHAT_LINKS_HERE):
+                tabs.insert(0, ('links', '/%s/%s' % (_WHAT_LINKS_HERE, subject),
+                                'articles linking to %s' % subject))
+            if self.__editable:
+                tabs.insert(0, ('edit', '/%s?action=edit' % subject,
+                                'edit %s' % subject))
             
 #        if subject == '':
 #            subject = '(Home)'
 
-        if subject.getNamespace() == manager.CATEGORY_NS:
-            subj_list = self.__buildSubjectList(art.getSubjects())
-            article_content += '\n<div id="wiki-subjects">\n' + subj_list \
-                               + '\n</div>'
-        
-        tabs_content = self.buildTabs(tabs)
         ns = u''
         if subject.getNamespace() != '':
             ns = u' class="' + subject.getNamespace().lower() + u'"'
-        html_content = u'<div id="wiki-content"%s>\n%s\n</div>\n' % (ns, article_content)
-        return self._buildPage(subject, tabs, html_content)
+
+        def generateContent():
+            yield u'<div id="wiki-content"%s>\n' % ns
+            if subject.getNamespace() == manager.SYSTEM_NS:
+                chunks = _split(art.getContent())
+            else:
+                chunks = self.iterFormatArticle(art)
+            for chunk in chunks:
+                yield chunk
+            if subject.getNamespace() == manager.CATEGORY_NS:
+                subj_list = self.__buildSubjectList(art.getSubjects())
+                yield '\n<div id="wiki-subjects">\n' + subj_list + '\n</div>'
+            yield u'\n</div>\n'
+
+        return self._buildPage(subject, tabs, generateContent())
 
     def buildEditPage(self, art):
         subject = art.getSubject()
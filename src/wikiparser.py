@@ -4,13 +4,26 @@
 import article
 import manager
 import formatter
+import cache
+import hashlib
 import re
+import threading
+
+# version of the parser output, to change each time the rendering of an
+# article changes (see L{cache.RenderStore})
+PARSER_VERSION = u"2"
+
+# maximum nesting depth of the templates
+MAX_TEMPLATE_DEPTH = 16
+# maximum number of templates expanded for an article
+MAX_TEMPLATE_EXPANSIONS = 500
+# maximum number of characters produced by the templates of an article
+MAX_TEMPLATE_SIZE = 2 * 1024 * 1024
 
 class ContentObject(object):
-    def __init__(self, type_name, pattern, is_open=False):
+    def __init__(self, type_name, pattern):
         self.__typeName = type_name
         self.__pattern = pattern
-        self.__isOpen = is_open
 
     def getTypeName(self):
         return self.__typeName
@@ -18,14 +31,280 @@ class ContentObject(object):
     def getPattern(self):
         return self.__pattern
 
-    def isOpen(self):
-        return self.__isOpen
+class FormatContext(object):
+    """State of a L{WikiParser} while it formats an article.
+
+    Each call to WikiParser.format works on its own context, so that a
+    parser can format several articles at the same time in different
+    threads.
+    """
+    def __init__(self, raw, resolved=(), existing=()):
+        # output of the article
+        self.raw = raw
+        # opened block elements
+        self.blockStack = []
+        self.isInList = False
+        self.listPos = u''
+        # categories declared by the article
+        self.categories = set()
+        # subjects the article links to
+        self.links = set()
+        # linked subjects whose existence is known, and the existing ones
+        self.resolved = resolved
+        self.existing = existing
+        # types of the opened formatting symbols (emph, strong...)
+        self.__open = set()
+
+    def switchOpen(self, type_name):
+        """Open a formatting symbol, or close it if it is open.
+
+        @return: True if the symbol is now open.
+        """
+        if type_name in self.__open:
+            self.__open.discard(type_name)
+            return False
+        self.__open.add(type_name)
+        return True
+
+def templateSubject(name):
+    """Get the subject of the template included by C{{{name}}}.
+    """
+    name = name.strip()
+    subject = article.Subject.fromString(name)
+    if subject.getNamespace() != manager.TEMPLATE_NS:
+        subject = article.Subject(name, manager.TEMPLATE_NS)
+    return subject
+
+class _ExpandState(object):
+    """State of the template expansion of an article.
+    """
+    def __init__(self):
+        # template subject -> template article (None if it doesn't exist)
+        self.fetched = {}
+        # subjects of the included templates
+        self.used = set()
+        self.count = 0
+        self.size = 0
+        # sets of the (subject, mtime) of the templates included by the
+        # templates being expanded (None if a limit has been reached)
+        self.deps = []
+
+class TemplateExpander(manager.ManagerListener):
+    """Expand the templates included by the content of an article.
+
+    The inclusion C{{{Title|value|name=value}}} is replaced by the content
+    of the article Template:Title, where C{{{{1}}}}, C{{{{name}}}} or
+    C{{{{name|default}}}} are replaced by the parameters. The templates
+    included by a template are expanded too. An inclusion of a template
+    which doesn't exist is replaced by a link to it. An inclusion loop or an
+    article exceeding the template limits (MAX_TEMPLATE_*) gets an error.
+
+    The expanded templates are memoized by (template, parameters,
+    modification time), along with the templates they include: an entry is
+    only used while those keep their modification time. An entry also keeps
+    the number and size of the expansions it was built from, which count
+    against the limits as if they were expanded again. As listener of the
+    wiki manager, the expander also drops the entries depending on a
+    template as soon as it is modified (the modification times of two
+    versions saved within a second are the same).
+
+    @param art_mgr: manager used to get the templates.
+    @param cache_size: size (in characters) of the memoized expansions, 0 to
+    disable the memoization.
+    """
+    def __init__(self, art_mgr, cache_size=0):
+        self.__art_mgr = art_mgr
+        self.__template_re = re.compile(WikiParser.template_rule, re.UNICODE)
+        self.__param_re = re.compile(WikiParser.template_param_rule, re.UNICODE)
+        # (subject, parameters, mtime) ->
+        #     (content, ((subject, mtime), ...), (expansions, size))
+        self.__cache = None
+        if cache_size > 0:
+            self.__cache = cache.LRUCache(cache_size,
+                                          sizeof=lambda entry: len(entry[0]),
+                                          evicted=self.__evicted)
+        # template subject -> keys of the entries depending on it
+        self.__dependents = {}
+        # guard the consistency between the entries and the dependencies
+        self.__lock = threading.RLock()
+
+    def __evicted(self, key, entry):
+        for subject in [key[0]] + [subject for subject, mtime in entry[1]]:
+            keys = self.__dependents.get(subject)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.__dependents[subject]
+
+    def __put(self, key, entry):
+        with self.__lock:
+            self.__cache.put(key, entry)
+            if key in self.__cache:
+                for subject in [key[0]] + [subject for subject, mtime in entry[1]]:
+                    self.__dependents.setdefault(subject, set()).add(key)
+
+    def invalidate(self, subject):
+        """Drop the expansions depending on a template.
+        """
+        if self.__cache is None:
+            return
+        with self.__lock:
+            for key in tuple(self.__dependents.get(subject, ())):
+                entry = self.__cache.get(key)
+                if entry is not None:
+                    self.__cache.delete(key)
+                    self.__evicted(key, entry)
+
+    def articleSet(self, subject, created):
+        if subject.getNamespace() == manager.TEMPLATE_NS:
+            self.invalidate(subject)
 
-    def setOpen(self, is_open):
-        self.__isOpen = is_open
+    def articleDeleted(self, subject):
+        if subject.getNamespace() == manager.TEMPLATE_NS:
+            self.invalidate(subject)
 
-    def switchOpen(self):
-        self.__isOpen = not self.__isOpen
+    def articlesReset(self):
+        if self.__cache is None:
+            return
+        with self.__lock:
+            self.__cache.clear()
+            self.__dependents.clear()
+
+    def expand(self, content):
+        """Expand the templates included by a content.
+
+        @return: the tuple (expanded content, subjects of the templates).
+        """
+        if u'{{' not in content:
+            return content, frozenset()
+        state = _ExpandState()
+        content = self.__expandText(state, content, ())
+        return content, frozenset(state.used)
+
+    def __expandText(self, state, text, stack):
+        # an expansion may form a new inclusion with the text around it
+        for i in range(MAX_TEMPLATE_DEPTH):
+            if u'{{' not in text:
+                break
+            text, count = self.__template_re.subn(
+                lambda match: self.__expandInclusion(state, match, stack), text)
+            if count == 0:
+                break
+        return text
+
+    def __fetch(self, state, subject):
+        if subject not in state.fetched:
+            art = None
+            if self.__art_mgr.contains(subject):
+                art = self.__art_mgr.get(subject)
+                if art.redirectTo() is not None:
+                    art = None
+            state.fetched[subject] = art
+        return state.fetched[subject]
+
+    def __getMTime(self, state, subject):
+        art = self.__fetch(state, subject)
+        if art is None:
+            return None
+        return art.getModificationTime()
+
+    def __error(self, state, message):
+        if len(state.deps) > 0:
+            # the expansions in progress can't be memoized
+            state.deps[-1].add(None)
+        return u'<span class="wiki-error">%s</span>' % message
+
+    def __expandInclusion(self, state, match, stack):
+        subject = templateSubject(match.group('_tmpl_title'))
+        state.used.add(subject)
+        if subject in stack:
+            return self.__error(state, u'Template loop: %s' % subject)
+        if len(stack) >= MAX_TEMPLATE_DEPTH \
+           or state.count >= MAX_TEMPLATE_EXPANSIONS:
+            return self.__error(state, u'Too many templates: %s' % subject)
+        state.count += 1
+
+        art = self.__fetch(state, subject)
+        mtime = None
+        if art is not None:
+            mtime = art.getModificationTime()
+        if len(state.deps) > 0:
+            state.deps[-1].add((subject, mtime))
+        if art is None:
+            return u'[[%s]]' % subject
+
+        params = self.__parseParams(match.group('_tmpl_param'))
+        key = (subject, params, mtime)
+        entry = None
+        if self.__cache is not None and mtime is not None:
+            entry = self.__cache.get(key)
+        if entry is not None:
+            text, deps, (count, size) = entry
+            if state.count + count > MAX_TEMPLATE_EXPANSIONS \
+               or state.size + size > MAX_TEMPLATE_SIZE:
+                # expanded again to get the errors at the same places
+                entry = None
+        if entry is not None:
+            for dep_subject, dep_mtime in deps:
+                if self.__getMTime(state, dep_subject) != dep_mtime:
+                    entry = None
+                    break
+        if entry is None:
+            count, size = state.count, state.size
+            state.deps.append(set())
+            text = self.__substitute(art.getContent(), dict(params))
+            text = self.__expandText(state, text, stack + (subject,))
+            deps = state.deps.pop()
+            if self.__cache is not None and mtime is not None \
+               and None not in deps:
+                self.__put(key, (text, tuple(deps),
+                                 (state.count - count, state.size - size)))
+        else:
+            state.used.update(dep_subject for dep_subject, dep_mtime in deps)
+            state.count += count
+            state.size += size
+        if len(state.deps) > 0:
+            state.deps[-1].update(deps)
+
+        state.size += len(text)
+        if state.size > MAX_TEMPLATE_SIZE:
+            return self.__error(state, u'Too many templates: %s' % subject)
+        return text
+
+    def __parseParams(self, param_st):
+        """Get the parameters of an inclusion as a sorted tuple of
+        (name, value), the positional parameters being named 1, 2...
+        """
+        params = {}
+        if param_st is not None:
+            position = 0
+            for param in _splitParams(param_st)[1:]:
+                name, sep, value = param.partition(u'=')
+                if sep != u'' and name.strip() != u'':
+                    params[name.strip()] = value.strip()
+                else:
+                    position += 1
+                    params[unicode(position)] = param
+        return tuple(sorted(params.items()))
+
+    def __substitute(self, content, params):
+        def substituteParam(match):
+            name = match.group('_param_name').strip()
+            if name in params:
+                return params[name]
+            if match.group('_param_default') is not None:
+                return match.group('_param_default')
+            return match.group(0)
+
+        # a default value may refer to another parameter
+        for i in range(MAX_TEMPLATE_DEPTH):
+            if u'{{{' not in content:
+                break
+            new_content = self.__param_re.sub(substituteParam, content)
+            if new_content == content:
+                break
+            content = new_content
+        return content
 
 class WikiParser(object):
     # punctuation
@@ -48,7 +327,9 @@ class WikiParser(object):
                     % {'subject': subject_rule,
                        'fragment': ur"""(?P<_subj_frag>[^\|\]\}]+)""",
                        'text': ur"""(?P<_subj_text>[^\]]+)"""}
-    template_rule = ur"""\{\{(?P<_tmpl_title>[^\|\]\}]+)(|?P<_tmpl_param>(\|[^\|\}]+)*)\}\}"""
+    # template inclusion and template parameter (innermost first)
+    template_rule = ur"""(?<!\{)\{\{(?!\{)(?P<_tmpl_title>[^\|\{\}]+)(?P<_tmpl_param>\|[^\{\}]*)?\}\}"""
+    template_param_rule = ur"""\{\{\{(?P<_param_name>[^\|\{\}]+)(\|(?P<_param_default>[^\{\}]*))?\}\}\}"""
     
     # url
     url_schema = ur"""http|https|file|ftp|mailto"""
@@ -80,15 +361,29 @@ class WikiParser(object):
     
     no_new_p_before = ('heading', 'li', 'html_mkup', 'processor')
     
-    def __init__(self, formatter, art_mgr):
+    def __init__(self, formatter, art_mgr, block_cache_size=0,
+                 template_cache_size=0):
+        """@param block_cache_size: size (in characters) of the cache of
+        the rendered blocks, 0 to disable it.
+        @param template_cache_size: size (in characters) of the memoized
+        template expansions (see L{TemplateExpander}), 0 to disable it.
+        """
         self.__art_mgr = art_mgr
         self.__formatter = formatter
-        self.__cntObjects = {}
+        self.__templates = TemplateExpander(art_mgr, template_cache_size)
+        # block hash -> (content, ((linked subject, exists), ...), categories)
+        self.__blockCache = None
+        if block_cache_size > 0:
+            self.__blockCache = cache.LRUCache(block_cache_size,
+                                               sizeof=lambda entry: len(entry[0]))
+        # type name -> replacer, or None
+        self.__dispatch = {}
         rules =  []
         for cnt_object in self.cnt_objects:
-            self.__cntObjects[cnt_object.getTypeName()] \
-                = ContentObject(cnt_object.getTypeName(), cnt_object.getPattern())
-            rules.append(ur"(?P<%s>%s)" % (cnt_object.getTypeName(), cnt_object.getPattern()))
+            type_name = cnt_object.getTypeName()
+            self.__dispatch[type_name] = getattr(self, '_' + type_name + '_repl',
+                                                 None)
+            rules.append(ur"(?P<%s>%s)" % (type_name, cnt_object.getPattern()))
         rules_st = u'|'.join(rules)
         self.__rules_re = re.compile(rules_st, re.MULTILINE | re.UNICODE)
         self.__html_re = re.compile(self.html_rule, re.MULTILINE | re.UNICODE)
@@ -96,58 +391,71 @@ class WikiParser(object):
         self.__intlink_re = re.compile(self.internal_link, re.UNICODE)
         self.__extlink_re = re.compile(self.external_link, re.UNICODE)
         self.__proc_re = re.compile(ur"%%(?P<command>[^\: ]+)\s*(\:(?P<params>([^\|]+|\|[^\|]+)+))?$")
-        
-        self.__blockStack = None
-        self.__isInList = False
-        self.__listPos = u''
-        self.__categories = set()
+        # links of the article last formatted by each thread
+        self.__local = threading.local()
+    
+    def getTemplateExpander(self):
+        """Get the expander of the templates, to register as listener of the
+        wiki manager.
+        """
+        return self.__templates
+
+    def getLinks(self):
+        """Get the subjects the last article formatted or rendered by the
+        calling thread links to.
+        """
+        return getattr(self.__local, 'links', frozenset())
+    
+    def __exists(self, ctxt, subject):
+        if subject in ctxt.resolved:
+            return subject in ctxt.existing
+        return self.__art_mgr.contains(subject)
     
-    def __closeAll(self, raw):
-        while len(self.__blockStack) > 0:
-            tag = self.__blockStack.pop()
-            self.__formatter.endElement(raw, tag)
-        self.__isInList = False
-        self.__listPos = u''
+    def __closeAll(self, ctxt):
+        while len(ctxt.blockStack) > 0:
+            tag = ctxt.blockStack.pop()
+            self.__formatter.endElement(ctxt.raw, tag)
+        ctxt.isInList = False
+        ctxt.listPos = u''
     
-    def __scan(self, raw, block):
+    def __scan(self, ctxt, block):
 #        print "New block: %s" % repr(block)
         lastpos = 0
         for match in self.__rules_re.finditer(block):
 #            print match.group(0)
             if lastpos < match.start():
-                if len(self.__blockStack) == 0:
-                    self.__blockStack.append(u'p')
-                    self.__formatter.startElement(raw, u'p', {'class': 'scan-1'})
+                if len(ctxt.blockStack) == 0:
+                    ctxt.blockStack.append(u'p')
+                    self.__formatter.startElement(ctxt.raw, u'p', {'class': 'scan-1'})
 #                print '''  1 --> %s''' % repr(block[lastpos:match.start()])
-                self.__formatter.text(raw, block[lastpos:match.start()])
+                self.__formatter.text(ctxt.raw, block[lastpos:match.start()])
             
-            self.__replace(raw, match)
+            self.__replace(ctxt, match)
             lastpos = match.end()
         
-        if len(self.__blockStack) == 0 and lastpos < len(block.rstrip()):
-            self.__blockStack.append(u'p')
-            self.__formatter.startElement(raw, u'p', {'class': 'scan-2'})
+        if len(ctxt.blockStack) == 0 and lastpos < len(block.rstrip()):
+            ctxt.blockStack.append(u'p')
+            self.__formatter.startElement(ctxt.raw, u'p', {'class': 'scan-2'})
 #        print '''  2 --> %s''' % repr(block[lastpos:])
-        self.__formatter.text(raw, block[lastpos:])
+        self.__formatter.text(ctxt.raw, block[lastpos:])
     
-    def __replace(self, raw, match):
-        for type, content in match.groupdict().items():
-            if content is None or type.startswith('_'):
-                continue
-            
-            if len(self.__blockStack) == 0 and type not in self.no_new_p_before:
-                self.__blockStack.append(u'p')
-                self.__formatter.startElement(raw, u'p', {'class': 'replace-1'})
-            
-            cnt_object = self.__cntObjects[type]
-            replacer_name = '_' + type + '_repl'
-            if hasattr(self, replacer_name):
-                replacer = getattr(self, replacer_name)
-                replacer(raw, content, cnt_object)
-            else:
-                self.__formatter.text(raw, content, {u'class': (u'untreat', type)})
+    def __replace(self, ctxt, match):
+        # the group of a rule encloses its subgroups, so that it is the last
+        # one to be closed
+        type = match.lastgroup
+        content = match.group(type)
+        
+        if len(ctxt.blockStack) == 0 and type not in self.no_new_p_before:
+            ctxt.blockStack.append(u'p')
+            self.__formatter.startElement(ctxt.raw, u'p', {'class': 'replace-1'})
+        
+        replacer = self.__dispatch[type]
+        if replacer is not None:
+            replacer(ctxt, content)
+        else:
+            self.__formatter.text(ctxt.raw, content, {u'class': (u'untreat', type)})
     
-    def _li_repl(self, raw, content, cnt_object):
+    def _li_repl(self, ctxt, content):
         def _diffLists(prev, next):
             i = 0
             while (i < len(prev)) and (i < len(next)) and (prev[i] == next[i]):
@@ -156,41 +464,41 @@ class WikiParser(object):
             to_open = next[i:]
             return to_close, to_open
 
-        def _openLists(raw, st):
+        def _openLists(st):
             for c in st:
                 tag = u'ul'
                 if c == '#':
                     tag = u'ol'
-                self.__blockStack.append(tag)
-                self.__formatter.startElement(raw, tag)
+                ctxt.blockStack.append(tag)
+                self.__formatter.startElement(ctxt.raw, tag)
     
-        def _closeLists(raw, st):
+        def _closeLists(st):
             for c in reversed(st):
                 tag = u'ul'
                 if c == '#':
                     tag = u'ol'
-                self.__blockStack.pop()
-                self.__formatter.endElement(raw, tag)
+                ctxt.blockStack.pop()
+                self.__formatter.endElement(ctxt.raw, tag)
 
         st = content.strip()
-        if not self.__isInList:
-            self.__closeAll(raw)
-            self.__isInList = True
-        if len(self.__blockStack) > 0 and self.__blockStack[-1] == u'li':
-            self.__blockStack.pop()
-            self.__formatter.endElement(raw, u'li')
+        if not ctxt.isInList:
+            self.__closeAll(ctxt)
+            ctxt.isInList = True
+        if len(ctxt.blockStack) > 0 and ctxt.blockStack[-1] == u'li':
+            ctxt.blockStack.pop()
+            self.__formatter.endElement(ctxt.raw, u'li')
         
-        to_close, to_open = _diffLists(self.__listPos, st)
+        to_close, to_open = _diffLists(ctxt.listPos, st)
 #        print "(_li_repl) close=%s, open=%s" % (to_close, to_open)
         
         if to_open != to_close:
-            _closeLists(raw, to_close)
-            _openLists(raw, to_open)
-            self.__listPos = st
-        self.__blockStack.append(u'li')
-        self.__formatter.startElement(raw, u'li')
+            _closeLists(to_close)
+            _openLists(to_open)
+            ctxt.listPos = st
+        ctxt.blockStack.append(u'li')
+        self.__formatter.startElement(ctxt.raw, u'li')
 
-    def _processor_repl(self, raw, content, cnt_object):
+    def _processor_repl(self, ctxt, content):
         match = self.__proc_re.match(content)
         if match is not None:
             cmd = match.group('command')
@@ -198,13 +506,13 @@ class WikiParser(object):
 #            print "%s - %s" % (cmd, params)
             if cmd == 'CATEGORY':
                 for param in params:
-                    self.__categories.add(param)
+                    ctxt.categories.add(param)
         return u''
 
-    def _html_ent_repl(self, raw, content, cnt_object):
-        raw.append(content)
+    def _html_ent_repl(self, ctxt, content):
+        ctxt.raw.append(content)
         
-    def _html_mkup_repl(self, raw, content, cnt_object):
+    def _html_mkup_repl(self, ctxt, content):
         isOpen = True
         isMarker = content.strip().endswith('/>')
         match = self.__html_re.match(content)
@@ -218,27 +526,27 @@ class WikiParser(object):
         isBlock = tag in self.html_block
         
         if isOpen:
-            if not isBlock and len(self.__blockStack) == 0:
-                self.__blockStack.append(u'p')
-                self.__formatter.startElement(raw, u'p', {'class': '_html_mkup_repl-1'})
+            if not isBlock and len(ctxt.blockStack) == 0:
+                ctxt.blockStack.append(u'p')
+                self.__formatter.startElement(ctxt.raw, u'p', {'class': '_html_mkup_repl-1'})
             if isBlock:
-                self.__closeAll(raw)
+                self.__closeAll(ctxt)
                 if not isMarker:
-                    self.__blockStack.append(tag)
+                    ctxt.blockStack.append(tag)
             attrs = {}
             for match in self.__html_param_re.finditer(param):
                 name = match.group('name')
                 value = match.group('value')[1:-1]
                 attrs[name] = value
-            self.__formatter.startElement(raw, tag, attrs)
+            self.__formatter.startElement(ctxt.raw, tag, attrs)
             if isMarker:
-                self.__formatter.endElement(raw, tag)
+                self.__formatter.endElement(ctxt.raw, tag)
         else:
             if isBlock:
-                self.__blockStack.pop()
-            self.__formatter.endElement(raw, tag)
+                ctxt.blockStack.pop()
+            self.__formatter.endElement(ctxt.raw, tag)
     
-    def _intlink_repl(self, raw, content, cnt_object):
+    def _intlink_repl(self, ctxt, content):
         match = self.__intlink_re.match(content)
         
         subj_st = match.group('_subj')
@@ -253,21 +561,22 @@ class WikiParser(object):
                 
         
         subject = article.Subject.fromString(subj_st)
+        ctxt.links.add(subject)
         link_cls = "wiki-undefined"
-        if self.__art_mgr.contains(subject):
+        if self.__exists(ctxt, subject):
             link_cls = "wiki-defined"
         href = u'/' + unicode(subject)
         if fragment is not None:
             href += u'#' + formatter.getId(fragment)
             subj_st += u'#' + fragment
         
-        self.__formatter.startElement(raw, u'a', {'href': href,
+        self.__formatter.startElement(ctxt.raw, u'a', {'href': href,
                                                   'title': subj_st,
                                                   'class': link_cls})
-        self.__formatter.text(raw, text)
-        self.__formatter.endElement(raw, u'a')
+        self.__formatter.text(ctxt.raw, text)
+        self.__formatter.endElement(ctxt.raw, u'a')
 
-    def _extlink_repl(self, raw, content, cnt_object):
+    def _extlink_repl(self, ctxt, content):
         match = self.__extlink_re.match(content)
         url = match.group('_url_1')
         text = match.group('_url_text')
@@ -278,20 +587,20 @@ class WikiParser(object):
         if url.startswith("mailto:"):
             link_cls = "wiki-mail"
 
-        self.__formatter.startElement(raw, u'a', {'href': url,
+        self.__formatter.startElement(ctxt.raw, u'a', {'href': url,
                                                   'title': url,
                                                   'class': link_cls})
-        self.__formatter.text(raw, text)
-        self.__formatter.endElement(raw, u'a')
+        self.__formatter.text(ctxt.raw, text)
+        self.__formatter.endElement(ctxt.raw, u'a')
 
-    def _email_repl(self, raw, content, cnt_object):
-        self.__formatter.startElement(raw, u'a', {'href': u"mailto:" + content,
+    def _email_repl(self, ctxt, content):
+        self.__formatter.startElement(ctxt.raw, u'a', {'href': u"mailto:" + content,
                                                   'title': content,
                                                   'class': "wiki-mail"})
-        self.__formatter.text(raw, content)
-        self.__formatter.endElement(raw, u'a')
+        self.__formatter.text(ctxt.raw, content)
+        self.__formatter.endElement(ctxt.raw, u'a')
 
-    def _heading_repl(self, raw, content, cnt_object):
+    def _heading_repl(self, ctxt, content):
         heading = content.strip()
         depth = 1
         while heading[depth] == '=':
@@ -300,94 +609,219 @@ class WikiParser(object):
 
         title = heading[depth:-depth].strip()
         heading_id = formatter.getId(title)
-        self.__closeAll(raw)
-        self.__formatter.startElement(raw, u'h%d' % depth, {'id': heading_id})
-        #self.__formatter.text(raw, title)
-        self.__blockStack.append(u'h%d' % depth)
-        self.__scan(raw, title)
-        self.__blockStack.pop()
-        self.__formatter.endElement(raw, u'h%d' % depth)
+        self.__closeAll(ctxt)
+        self.__formatter.startElement(ctxt.raw, u'h%d' % depth, {'id': heading_id})
+        #self.__formatter.text(ctxt.raw, title)
+        ctxt.blockStack.append(u'h%d' % depth)
+        self.__scan(ctxt, title)
+        ctxt.blockStack.pop()
+        self.__formatter.endElement(ctxt.raw, u'h%d' % depth)
     
-    def _emph_repl(self, raw, content, cnt_object):
-        cnt_object.switchOpen()
-        if cnt_object.isOpen():
-            self.__formatter.startElement(raw, u'em')
+    def _emph_repl(self, ctxt, content):
+        is_open = ctxt.switchOpen('emph')
+        if is_open:
+            self.__formatter.startElement(ctxt.raw, u'em')
         else:
-            self.__formatter.endElement(raw, u'em')
+            self.__formatter.endElement(ctxt.raw, u'em')
     
-    def _strong_repl(self, raw, content, cnt_object):
-        cnt_object.switchOpen()
-        if cnt_object.isOpen():
-            self.__formatter.startElement(raw, u'strong')
+    def _strong_repl(self, ctxt, content):
+        is_open = ctxt.switchOpen('strong')
+        if is_open:
+            self.__formatter.startElement(ctxt.raw, u'strong')
         else:
-            self.__formatter.endElement(raw, u'strong')
+            self.__formatter.endElement(ctxt.raw, u'strong')
     
-    def _underline_repl(self, raw, content, cnt_object):
-        cnt_object.switchOpen()
-        if cnt_object.isOpen():
-            self.__formatter.startElement(raw, u'span', {'class': 'wiki-underline'})
+    def _underline_repl(self, ctxt, content):
+        is_open = ctxt.switchOpen('underline')
+        if is_open:
+            self.__formatter.startElement(ctxt.raw, u'span', {'class': 'wiki-underline'})
         else:
-            self.__formatter.endElement(raw, u'span')
+            self.__formatter.endElement(ctxt.raw, u'span')
     
-    def _strike_repl(self, raw, content, cnt_object):
-        cnt_object.switchOpen()
-        assert (cnt_object.isOpen() and content == '--(') or (not cnt_object.isOpen() and content == ')--')
-        if cnt_object.isOpen():
-            self.__formatter.startElement(raw, u'span', {'class': 'wiki-strike'})
+    def _strike_repl(self, ctxt, content):
+        is_open = ctxt.switchOpen('strike')
+        assert (is_open and content == '--(') or (not is_open and content == ')--')
+        if is_open:
+            self.__formatter.startElement(ctxt.raw, u'span', {'class': 'wiki-strike'})
         else:
-            self.__formatter.endElement(raw, u'span')
+            self.__formatter.endElement(ctxt.raw, u'span')
     
-    def __doCategories(self, raw, categories):
+    def __doCategories(self, ctxt, categories):
         def cat2ref(cat_st):
             title = article.norm_subj_elem(cat_st)
             subject = article.Subject(title, manager.CATEGORY_NS)
+            ctxt.links.add(subject)
             link_cls = "wiki-undefined"
-            if self.__art_mgr.contains(subject):
+            if self.__exists(ctxt, subject):
                 link_cls = "wiki-defined"
             href = u'/' + unicode(subject)
             return title, subject, link_cls, href
         
-        self.__formatter.startElement(raw, u'div', {'id': 'wiki-categories'})
-        raw.append(u'Category: ')
+        self.__formatter.startElement(ctxt.raw, u'div', {'id': 'wiki-categories'})
+        ctxt.raw.append(u'Category: ')
         cat_r = []
         cat_list = sorted(categories)
         for i in range(len(cat_list)-1):
             cat_st = cat_list[i]
             title, subject, link_cls, href = cat2ref(cat_st)
-            self.__formatter.startElement(raw, u'a', {'href': href,
+            self.__formatter.startElement(ctxt.raw, u'a', {'href': href,
                                                       'title': unicode(subject),
                                                       'class': link_cls})
-            self.__formatter.text(raw, title)
-            self.__formatter.endElement(raw, u'a')
-            self.__formatter.text(raw, u' | ')
+            self.__formatter.text(ctxt.raw, title)
+            self.__formatter.endElement(ctxt.raw, u'a')
+            self.__formatter.text(ctxt.raw, u' | ')
         if len(cat_list) > 0:
             title, subject, link_cls, href = cat2ref(cat_list[-1])
-            self.__formatter.startElement(raw, u'a', {'href': href,
+            self.__formatter.startElement(ctxt.raw, u'a', {'href': href,
                                                       'title': unicode(subject),
                                                       'class': link_cls})
-            self.__formatter.text(raw, title)
-            self.__formatter.endElement(raw, u'a')
+            self.__formatter.text(ctxt.raw, title)
+            self.__formatter.endElement(ctxt.raw, u'a')
             
-        self.__formatter.endElement(raw, u'div')
+        self.__formatter.endElement(ctxt.raw, u'div')
 
-    def format(self, art):
-        self.__blockStack = []
-        self.__isInList = False
-        self.__listPos = u''
-        self.__categories = set()
-        
-        subject, content = art.getSubject(), art.getContent()
-        raw = formatter.RawOutput()
+    def __formatBlock(self, ctxt, block):
+        """Format a block of an article, or get it from the block cache.
+
+        A block is rendered independently of the other blocks: all its
+        elements are closed at its end. A cached block is only valid while
+        the subjects it links to keep their existence state.
+        """
+        if self.__blockCache is None:
+            self.__scan(ctxt, block)
+            self.__closeAll(ctxt)
+            return
+        key = hashlib.md5(block.encode('utf8')).digest()
+        entry = self.__blockCache.get(key)
+        if entry is not None:
+            content, link_states, categories = entry
+            for subject, exists in link_states:
+                if self.__exists(ctxt, subject) != exists:
+                    entry = None
+                    break
+        if entry is None:
+            block_ctxt = FormatContext(formatter.RawOutput(), ctxt.resolved,
+                                       ctxt.existing)
+            self.__scan(block_ctxt, block)
+            self.__closeAll(block_ctxt)
+            content = block_ctxt.raw.getRaw()
+            link_states = tuple((subject, self.__exists(ctxt, subject))
+                                for subject in block_ctxt.links)
+            categories = frozenset(block_ctxt.categories)
+            self.__blockCache.put(key, (content, link_states, categories))
+        ctxt.raw.append(content)
+        ctxt.links.update(subject for subject, exists in link_states)
+        ctxt.categories.update(categories)
+
+    def render(self, art):
+        """Format an article.
+
+        @return: the tuple (rendered content, subjects it links to or
+        includes).
+        """
+        links = set()
+        content = u''.join(self.iterRender(art, links))
+        return content, frozenset(links)
+
+    def iterRender(self, art, links=None):
+        """Format an article block by block.
+
+        The content of each block is generated as soon as it is formatted.
+        Once the generator is exhausted, the subjects the article links to
+        or includes are added to links, if given, and given by getLinks in
+        the same thread.
+        """
+        content, templates = self.__templates.expand(art.getContent())
+        # resolve the existence of all linked subjects at once
+        resolved = extractLinks(content)
+        ctxt = FormatContext(formatter.RawOutput(), resolved,
+                             self.__art_mgr.filterExisting(resolved))
+        # the article is rendered again when its templates change
+        ctxt.links.update(templates)
         blocks = re.split('\r?\n(?:[ \t]*\r?\n)+', content.strip())
 #        pprint.pprint(blocks)
         for block in blocks:
-            self.__scan(raw, block)
-            self.__closeAll(raw)
+            self.__formatBlock(ctxt, block)
+            raw = ctxt.raw.takeRaw()
+            if len(raw) > 0:
+                yield raw
         
-        if len(self.__categories) > 0:
-            self.__doCategories(raw, self.__categories)
+        if len(ctxt.categories) > 0:
+            self.__doCategories(ctxt, ctxt.categories)
+            yield ctxt.raw.takeRaw()
             
-        return raw.getRaw()
+        if links is not None:
+            links.update(ctxt.links)
+        self.__local.links = frozenset(ctxt.links)
+
+    def format(self, art):
+        """Format an article.
+
+        The subjects it links to are then given by getLinks, in the same
+        thread.
+        """
+        return self.render(art)[0]
+
+_intlink_re = re.compile(WikiParser.internal_link, re.UNICODE)
+_template_re = re.compile(WikiParser.template_rule, re.UNICODE)
+_processor_re = re.compile(ur"^%%.*$", re.MULTILINE | re.UNICODE)
+_proc_re = re.compile(ur"%%(?P<command>[^\: ]+)\s*(\:(?P<params>([^\|]+|\|[^\|]+)+))?$")
+
+_param_sep_re = re.compile(ur"\[\[|\]\]|\|", re.UNICODE)
+
+def _splitParams(param_st):
+    """Split the parameters of an inclusion on the pipes which aren't inside
+    a link (C{[[Title|text]]}).
+    """
+    params = []
+    depth = 0
+    pos = 0
+    for match in _param_sep_re.finditer(param_st):
+        sep = match.group(0)
+        if sep == u'[[':
+            depth += 1
+        elif sep == u']]':
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            params.append(param_st[pos:match.start()])
+            pos = match.end()
+    params.append(param_st[pos:])
+    return params
+
+def extractLinks(content):
+    """Get the subjects a content links to: the subjects of its internal
+    links and categories, and the templates it includes.
+
+    The templates are not expanded: the links of a template belong to the
+    template article, and the links built from the parameters of a template
+    (C{[[{{{1}}}]]}) are not found.
+    """
+    subjects = set()
+    for match in _intlink_re.finditer(content):
+        subj_st = match.group('_subj')
+        if subj_st is None:
+            subj_st = u''
+        subjects.add(article.Subject.fromString(subj_st))
+    for match in _processor_re.finditer(content):
+        match = _proc_re.match(match.group(0))
+        if match is not None and match.group('command') == 'CATEGORY' \
+           and match.group('params') is not None:
+            for param in match.group('params').split('|'):
+                title = article.norm_subj_elem(param.strip())
+                subjects.add(article.Subject(title, manager.CATEGORY_NS))
+
+    def collectInclusion(match):
+        subjects.add(templateSubject(match.group('_tmpl_title')))
+        return u''
+
+    # the inclusions are found innermost first
+    for i in range(MAX_TEMPLATE_DEPTH):
+        if u'{{' not in content:
+            break
+        content, count = _template_re.subn(collectInclusion, content)
+        if count == 0:
+            break
+    return subjects
 
 if __name__ == '__main__':
     class Article(object):
@@ -401,7 +835,7 @@ if __name__ == '__main__':
         def getContent(self):
             return self.__content
     
-    class ArticleManager(object):
+    class ArticleManager(article.ArticleManager):
         def contains(self, *args):
             return False
 
@@ -431,4 +865,24 @@ http://google.fr/ untel.name@company.com
     parser = WikiParser(formatter.HtmlBuilder(), ArticleManager())
     print parser.format(art)
 
+    class TemplateManager(article.ArticleManager):
+        def __init__(self, templates):
+            self.__templates = dict(
+                (article.Subject(title, manager.TEMPLATE_NS),
+                 article.UserArticle(article.Subject(title, manager.TEMPLATE_NS),
+                                     content))
+                for title, content in templates.items())
+
+        def contains(self, subject):
+            return subject in self.__templates
+
+        def get(self, subject):
+            return self.__templates[subject]
+
+    # a link inside a parameter keeps its pipe
+    expander = TemplateExpander(TemplateManager(
+        {u'Info': u'Link: {{{link}}}, {{{1}}}'}))
+    expanded = expander.expand(u'{{Info|link=[[Bar|the bar]]|[[Baz|baz]]}}')[0]
+    assert expanded == u'Link: [[Bar|the bar]], [[Baz|baz]]', expanded
+
 # End